@@ -0,0 +1,414 @@
+"""Convergence benchmarks for LinkStateNode flooding and the LSDB.
+
+Builds a reproducible topology of LinkStateNodes on a shared MemoryTransport,
+waits for the LSDBs to converge, then fails and restores links one at a time
+with `remove_link`/`add_link`. For every phase it records the time until all
+LSDBs agree again and the messages and bytes the transport carried. The report
+is printed (or written) as JSON so results can be compared between releases.
+
+    python convergence_benchmark.py --topology grid --nodes 100 --failures 5
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import platform
+import random
+import time
+import tracemalloc
+
+from lsn_async import LinkStateNode
+from metrics import Counter
+from tracing import write_chrome_trace
+from transport import MemoryTransport
+from wire_protocol import BINARY, JSON
+
+
+def ring(n, rng):
+    if n <= 2:
+        return [0, 1], [(0, 1)]
+    return list(range(n)), [(i, (i + 1) % n) for i in range(n)]
+
+
+def grid(n, rng):
+    side = max(2, math.isqrt(n))
+    nodes = list(range(side * side))
+    edges = []
+    for row in range(side):
+        for col in range(side):
+            node = row * side + col
+            if col + 1 < side:
+                edges.append((node, node + 1))
+            if row + 1 < side:
+                edges.append((node, node + side))
+    return nodes, edges
+
+
+def fat_tree(k, rng):
+    """Switches of a k-ary fat tree: k pods of k/2 edge and k/2 aggregation
+    switches, connected through (k/2)^2 core switches."""
+    half = k // 2
+    core = list(range(half * half))
+    edges = []
+    next_id = len(core)
+    for _ in range(k):
+        aggregation = list(range(next_id, next_id + half))
+        edge = list(range(next_id + half, next_id + 2 * half))
+        next_id += 2 * half
+        edges.extend((a, e) for a in aggregation for e in edge)
+        for position, a in enumerate(aggregation):
+            edges.extend((c, a) for c in core[position * half:(position + 1) * half])
+    return list(range(next_id)), edges
+
+
+def erdos_renyi(n, rng, p=0.05):
+    nodes = list(range(n))
+    edges = [(a, b) for a, b in itertools.combinations(nodes, 2) if rng.random() < p]
+    return nodes, connect_components(nodes, edges, rng)
+
+
+def barabasi_albert(n, rng, m=2):
+    m = max(1, min(m, n - 1))
+    edges = [(a, b) for a, b in itertools.combinations(range(m + 1), 2)]
+    endpoints = [node for edge in edges for node in edge]
+    for node in range(m + 1, n):
+        targets = set()
+        while len(targets) < m:
+            targets.add(rng.choice(endpoints))
+        for target in targets:
+            edges.append((target, node))
+            endpoints.extend((target, node))
+    return list(range(n)), edges
+
+
+TOPOLOGIES = {
+    "ring": ring,
+    "grid": grid,
+    "fat-tree": fat_tree,
+    "erdos-renyi": erdos_renyi,
+    "barabasi-albert": barabasi_albert,
+}
+
+
+def components(nodes, edges):
+    adjacency = {node: set() for node in nodes}
+    for a, b in edges:
+        adjacency[a].add(b)
+        adjacency[b].add(a)
+    seen, result = set(), []
+    for start in nodes:
+        if start in seen:
+            continue
+        component, stack = [], [start]
+        seen.add(start)
+        while stack:
+            node = stack.pop()
+            component.append(node)
+            for neighbor in adjacency[node] - seen:
+                seen.add(neighbor)
+                stack.append(neighbor)
+        result.append(component)
+    return result
+
+
+def connect_components(nodes, edges, rng):
+    parts = components(nodes, edges)
+    for left, right in zip(parts, parts[1:]):
+        edges.append((rng.choice(left), rng.choice(right)))
+    return edges
+
+
+def pick_failures(nodes, edges, count, rng):
+    """Pick up to `count` links whose loss keeps the topology connected."""
+    candidates = list(edges)
+    rng.shuffle(candidates)
+    failures = []
+    for edge in candidates:
+        if len(failures) == count:
+            break
+        remaining = [e for e in edges if e != edge]
+        if len(components(nodes, remaining)) == 1:
+            failures.append(edge)
+    return failures
+
+
+def lsdb_digest(node):
+    snapshot = node.lsdb.snapshot()
+    return hash(
+        frozenset((key, lsa.sequence_number) for key, lsa in snapshot.items())
+    )
+
+
+class ConvergenceMonitor:
+    """Tells when every node holds the same, complete LSDB.
+
+    Digests are cached per node by LSDB generation, so polling only rehashes
+    the databases that changed since the last poll.
+    """
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.cache = {}
+
+    def digest(self, node):
+        generation = node.lsdb.snapshot().generation
+        cached = self.cache.get(node.id)
+        if cached is None or cached[0] != generation:
+            cached = self.cache[node.id] = (generation, lsdb_digest(node))
+        return cached[1]
+
+    def converged(self, required=None):
+        expected = len(self.nodes)
+        first = self.nodes[0]
+        if len(first.lsdb) != expected:
+            return False
+        for router_id, sequence_number in (required or {}).items():
+            lsa = first.lsdb.database.get(router_id)
+            if lsa is None or lsa.sequence_number < sequence_number:
+                return False
+        digest = self.digest(first)
+        return all(
+            len(node.lsdb) == expected and self.digest(node) == digest
+            for node in self.nodes
+        )
+
+    async def wait(self, timeout, poll_interval, required=None):
+        start = time.perf_counter()
+        while time.perf_counter() - start < timeout:
+            if self.converged(required):
+                return time.perf_counter() - start
+            await asyncio.sleep(poll_interval)
+        return None
+
+
+async def wait_until(predicate, timeout, poll_interval):
+    start = time.perf_counter()
+    while not predicate():
+        if time.perf_counter() - start > timeout:
+            return False
+        await asyncio.sleep(poll_interval)
+    return True
+
+
+async def originate(nodes):
+    for node in nodes:
+        await node.send_neighbor_lsa()
+    for node in nodes:
+        await node.lsa_throttle.wait()
+    return {node.id: node.lsdb.database[node.id].sequence_number for node in nodes}
+
+
+async def measure(name, link, transport, monitor, action, args):
+    writes, sent = transport.writes, transport.bytes_sent
+    start = time.perf_counter()
+    required = await action()
+    remaining = max(0.0, args.timeout - (time.perf_counter() - start))
+    converged = await monitor.wait(remaining, args.poll_interval, required) is not None
+    result = {
+        "event": name,
+        "converged": converged,
+        "convergence_seconds": time.perf_counter() - start if converged else None,
+        "messages": transport.writes - writes,
+        "bytes": transport.bytes_sent - sent,
+    }
+    if link is not None:
+        result["link"] = list(link)
+    return result
+
+
+def total_counters(nodes):
+    """Sum every counter over all nodes, keyed by metric name."""
+    totals = {}
+    for node in nodes:
+        for name, metric in node.metrics.metrics.items():
+            if isinstance(metric, Counter):
+                for _, _, value in metric.samples({}):
+                    totals[name] = totals.get(name, 0) + value
+    return dict(sorted(totals.items()))
+
+
+def build_topology(args):
+    """Return the node ids, edges, edge costs and links to fail for `args`."""
+    rng = random.Random(args.seed)
+    builder = TOPOLOGIES[args.topology]
+    if args.topology == "fat-tree":
+        ids, edges = builder(args.k, rng)
+    elif args.topology == "erdos-renyi":
+        ids, edges = builder(args.nodes, rng, args.p)
+    elif args.topology == "barabasi-albert":
+        ids, edges = builder(args.nodes, rng, args.m)
+    else:
+        ids, edges = builder(args.nodes, rng)
+    costs = {edge: rng.randint(1, args.max_cost) for edge in edges}
+    failures = pick_failures(ids, edges, args.failures, rng)
+    return ids, edges, costs, failures
+
+
+def throttle_options(args):
+    return {
+        "lsa_min_hold": args.lsa_min_hold,
+        "lsa_max_hold": args.lsa_max_hold,
+        "spf_min_hold": args.spf_min_hold,
+        "spf_max_hold": args.spf_max_hold,
+    }
+
+
+def parameters(args):
+    return {
+        "seed": args.seed,
+        "k": args.k,
+        "p": args.p,
+        "m": args.m,
+        "max_cost": args.max_cost,
+        "latency": args.latency,
+        "loss": args.loss,
+        "wire_format": args.wire_format,
+        "hello_interval": args.hello_interval,
+        "dead_interval": args.dead_interval,
+        "lsa_interval": args.lsa_interval,
+        "lsa_hold": [args.lsa_min_hold, args.lsa_max_hold],
+        "spf_hold": [args.spf_min_hold, args.spf_max_hold],
+    }
+
+
+async def run_benchmark(args):
+    ids, edges, costs, failures = build_topology(args)
+
+    tracemalloc.start()
+    transport = MemoryTransport(latency=args.latency, loss=args.loss, seed=args.seed)
+    nodes = {
+        node_id: LinkStateNode(
+            node_id,
+            wire_format=args.wire_format,
+            transport=transport,
+            hello_interval=args.hello_interval,
+            dead_interval=args.dead_interval,
+            lsa_interval=args.lsa_interval,
+            **throttle_options(args),
+        )
+        for node_id in ids
+    }
+    monitor = ConvergenceMonitor(list(nodes.values()))
+    events = []
+
+    for node in nodes.values():
+        if args.trace:
+            node.start_tracing(args.trace_capacity)
+        await node.turn_on()
+
+    async def bring_up():
+        for a, b in edges:
+            await nodes[a].add_link(b, costs[(a, b)])
+        await wait_until(
+            lambda: all(a in nodes[b].direct_connection for a, b in edges),
+            args.timeout,
+            args.poll_interval,
+        )
+        return await originate(nodes.values())
+
+    events.append(await measure("initial", None, transport, monitor, bring_up, args))
+
+    for a, b in failures:
+
+        async def fail():
+            await nodes[a].remove_link(b)
+            await wait_until(
+                lambda: a not in nodes[b].direct_connection,
+                args.timeout,
+                args.poll_interval,
+            )
+            return await originate([nodes[a], nodes[b]])
+
+        async def recover():
+            await nodes[a].add_link(b, costs[(a, b)])
+            await wait_until(
+                lambda: a in nodes[b].direct_connection,
+                args.timeout,
+                args.poll_interval,
+            )
+            return await originate([nodes[a], nodes[b]])
+
+        events.append(await measure("link_down", (a, b), transport, monitor, fail, args))
+        events.append(await measure("link_up", (a, b), transport, monitor, recover, args))
+
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    counters = total_counters(nodes.values())
+    if args.trace:
+        write_chrome_trace(args.trace, [node.stop_tracing() for node in nodes.values()])
+    for node in nodes.values():
+        await node.turn_off()
+
+    return {
+        "benchmark": "convergence",
+        "topology": args.topology,
+        "nodes": len(ids),
+        "links": len(edges),
+        "parameters": parameters(args),
+        "events": events,
+        "messages": transport.writes,
+        "bytes": transport.bytes_sent,
+        "dropped_messages": transport.writes_dropped,
+        "counters": counters,
+        "peak_memory_bytes": peak,
+        # The process-wide peak spread over the nodes, not any node's own peak
+        "mean_memory_per_node_bytes": peak // max(1, len(ids)),
+        "python": platform.python_version(),
+    }
+
+
+def build_parser(description=__doc__.splitlines()[0]):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--topology", choices=sorted(TOPOLOGIES), default="ring")
+    parser.add_argument("--nodes", type=int, default=50)
+    parser.add_argument("--k", type=int, default=4, help="fat-tree arity")
+    parser.add_argument("--p", type=float, default=0.05, help="Erdős–Rényi edge probability")
+    parser.add_argument("--m", type=int, default=2, help="Barabási–Albert edges per new node")
+    parser.add_argument("--max-cost", type=int, default=1)
+    parser.add_argument("--failures", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--wire-format", choices=[JSON, BINARY], default=JSON)
+    parser.add_argument("--hello-interval", type=float, default=15)
+    parser.add_argument(
+        "--dead-interval", type=float, help="default: 4 hello intervals"
+    )
+    parser.add_argument("--lsa-interval", type=float, default=30)
+    parser.add_argument("--lsa-min-hold", type=float, default=0.05)
+    parser.add_argument("--lsa-max-hold", type=float, default=5.0)
+    parser.add_argument("--spf-min-hold", type=float, default=0.01)
+    parser.add_argument("--spf-max-hold", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--poll-interval", type=float, default=0.01)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument(
+        "--trace", help="write a Chrome trace of every node's message pipeline here"
+    )
+    parser.add_argument(
+        "--trace-capacity", type=int, default=4096, help="spans kept per node"
+    )
+    parser.add_argument("--log-level", default="WARNING")
+    return parser
+
+
+def parse_args(argv=None):
+    return build_parser().parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper())
+    report = asyncio.run(run_benchmark(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+class DuplicateFilter:
+    """Remembers which (link_state_id, sequence_number) pairs were seen.
+
+    For every originator only the highest sequence number seen is kept, plus a
+    bitmask of the `window` sequence numbers just below it, so memory is
+    O(originators) instead of O(LSAs ever received). Sequence numbers that fall
+    below the window are reported as not seen; they are older than the LSA
+    in the database, so comparing against it decides what to do with them.
+    """
+
+    def __init__(self, window: int = 64):
+        self.window = window
+        self.originators = {}
+
+    def __contains__(self, state):
+        link_state_id, sequence_number = state
+        entry = self.originators.get(link_state_id)
+        if entry is None:
+            return False
+        highest, seen = entry
+        if sequence_number > highest:
+            return False
+        offset = highest - sequence_number
+        return offset < self.window and bool(seen >> offset & 1)
+
+    def add(self, state):
+        link_state_id, sequence_number = state
+        entry = self.originators.get(link_state_id)
+        if entry is None:
+            self.originators[link_state_id] = (sequence_number, 1)
+            return
+        highest, seen = entry
+        if sequence_number > highest:
+            gap = sequence_number - highest
+            # A jump past the window leaves nothing of the old mask; shifting
+            # would build an integer as wide as the gap.
+            seen = (seen << gap) | 1 if gap < self.window else 1
+            highest = sequence_number
+        elif highest - sequence_number < self.window:
+            seen |= 1 << (highest - sequence_number)
+        self.originators[link_state_id] = (highest, seen & ((1 << self.window) - 1))
+
+    def __len__(self):
+        return len(self.originators)
+
+    def __str__(self):
+        return f"DuplicateFilter(originators={len(self.originators)}, window={self.window})"
+
+    def __repr__(self):
+        return str(self)
@@ -0,0 +1,310 @@
+"""What-if analysis of every single link and single node failure in an LSDB.
+
+The two-way links of the LSDB are packed into a compressed sparse row (CSR)
+`Topology`, which is cheap to ship to a pool of worker processes. Each worker
+takes a share of the routers as roots. For every root it builds one
+`ShortestPathTree`, then applies each failure that touches the root's
+shortest-path DAG as an incremental update and rolls it back, recording the
+destinations whose cost or next hops changed. Failures of links off the DAG
+cannot change the root's routes and are skipped without any SPF work.
+
+    python failure_analysis.py node-1.lsdb --workers 8 --output report.json
+"""
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import time
+from array import array
+
+from link_state_database import Link, LinkStatePacket
+from lsdb_persistence import load_lsdb
+from shortest_path_first import ShortestPathTree
+
+logger = logging.getLogger(__name__)
+
+
+class Topology:
+    """Two-way links of an LSDB in CSR form.
+
+    Routers are numbered by their position in `ids`. The links of router `i`
+    are `targets[offsets[i]:offsets[i + 1]]`, with the cost it advertises for
+    each at the same positions in `costs`. Like `ShortestPathTree`, only links
+    with a positive cost that both ends advertise are kept.
+    """
+
+    def __init__(self, ids, offsets, targets, costs):
+        self.ids = ids
+        self.offsets = offsets
+        self.targets = targets
+        self.costs = costs
+        self.index = {router_id: i for i, router_id in enumerate(ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __str__(self):
+        return f"Topology(routers={len(self)}, links={len(self.targets) // 2})"
+
+    def __repr__(self):
+        return str(self)
+
+    @classmethod
+    def from_lsas(cls, lsas):
+        """Build from LinkStatePackets (such as `LinkStateDatabase.snapshot()
+        .values()`) or their dicts (such as `SavedLsdb.lsas`)."""
+        advertised = {}
+        for lsa in lsas:
+            if isinstance(lsa, dict):
+                lsa = LinkStatePacket.from_dict(lsa)
+            links = advertised[lsa.link_state_id] = {}
+            for link_id, cost in lsa.links.pairs():
+                if link_id != lsa.link_state_id and cost > 0:
+                    links[link_id] = cost
+        ids = sorted(advertised)
+        index = {router_id: i for i, router_id in enumerate(ids)}
+        offsets, targets, costs = array("q", [0]), array("q"), array("q")
+        for router_id in ids:
+            for neighbor, cost in advertised[router_id].items():
+                if router_id in advertised.get(neighbor, ()):
+                    targets.append(index[neighbor])
+                    costs.append(cost)
+            offsets.append(len(targets))
+        return cls(ids, offsets, targets, costs)
+
+    def neighbors(self, i):
+        for k in range(self.offsets[i], self.offsets[i + 1]):
+            yield self.targets[k], self.costs[k]
+
+    def links(self):
+        """Each two-way link once, as a pair of router indexes."""
+        for i in range(len(self.ids)):
+            for j, _ in self.neighbors(i):
+                if i < j:
+                    yield i, j
+
+    def link_state_packets(self):
+        """One packet per router carrying only its two-way links."""
+        return [
+            LinkStatePacket(
+                router_id,
+                0,
+                router_id,
+                [Link(self.ids[j], cost) for j, cost in self.neighbors(i)],
+                0,
+            )
+            for i, router_id in enumerate(self.ids)
+        ]
+
+    def breadth_first(self, root):
+        order, seen = [root], {root}
+        for i in order:
+            for j, _ in self.neighbors(i):
+                if j not in seen:
+                    seen.add(j)
+                    order.append(j)
+        return order
+
+
+# Set in every worker process by _start_worker
+_topology = None
+_packets = None
+
+
+def _start_worker(topology):
+    global _topology, _packets
+    _topology = topology
+    _packets = topology.link_state_packets()
+
+
+def _changes(spf, changed, distance, next_hops):
+    rows = []
+    for destination in changed:
+        row = (
+            destination,
+            distance.get(destination),
+            spf.distance.get(destination),
+            next_hops.get(destination, frozenset()),
+            spf.next_hops.get(destination, frozenset()),
+        )
+        if row[1] != row[2] or row[3] != row[4]:
+            rows.append(row)
+    return rows
+
+
+def _restore(spf, router_id, links, rows, distance, next_hops):
+    """Undo a failure applied to `spf`: put back the links `router_id` had
+    and the baseline routes of the destinations that changed."""
+    if links is None:
+        spf.graph.pop(router_id, None)
+    else:
+        spf.graph[router_id] = links
+    for destination, *_ in rows:
+        spf.distance[destination] = distance[destination]
+        spf.next_hops[destination] = next_hops[destination]
+
+
+def _analyze_roots(roots):
+    """Return (scenario, root id, changed routes) for every failure that
+    changes the routes of a root in `roots`."""
+    topology, packets, ids = _topology, _packets, _topology.ids
+    results = []
+    for root in roots:
+        spf = ShortestPathTree(ids[root])
+        # Growing the tree outwards from the root keeps every update cheap.
+        reachable = topology.breadth_first(root)
+        for i in reachable:
+            spf.update(ids[i], packets[i])
+        distance = dict(spf.distance)
+        next_hops = dict(spf.next_hops)
+
+        # Only links on some shortest path from the root can move its routes,
+        # and only routers with such a link towards another one are transit.
+        on_dag, transit = set(), set()
+        for i in reachable:
+            for j, cost in topology.neighbors(i):
+                if distance[ids[i]] + cost == distance[ids[j]]:
+                    on_dag.add((min(i, j), max(i, j)))
+                    transit.add(i)
+
+        # Each failure is applied as an incremental update, then rolled back
+        # by restoring the baseline of what it changed.
+        for i, j in sorted(on_dag):
+            packet = packets[i]
+            links = spf.graph.get(ids[i])
+            failed = packet.replace(
+                links=[link for link in packet.links if link.link_id != ids[j]]
+            )
+            rows = _changes(spf, spf.update(ids[i], failed), distance, next_hops)
+            _restore(spf, ids[i], links, rows, distance, next_hops)
+            if rows:
+                results.append((("link", i, j), ids[root], rows))
+
+        for i in reachable:
+            router_id = ids[i]
+            if i == root:
+                continue
+            if i in transit:
+                links = spf.graph.get(router_id)
+                rows = _changes(spf, spf.update(router_id, None), distance, next_hops)
+                _restore(spf, router_id, links, rows, distance, next_hops)
+            else:
+                # No shortest path goes through the router, so losing it only
+                # loses the route to it.
+                rows = [
+                    (router_id, distance[router_id], None, next_hops[router_id], frozenset())
+                ]
+            results.append((("node", i), ids[root], rows))
+    return results
+
+
+def analyze(lsas, roots=None, workers=None, details=True):
+    """Report how routing changes under every single link and node failure.
+
+    `lsas` is what `Topology.from_lsas` accepts. `roots` limits the routers
+    whose routes are compared (default: all of them). With more than one
+    worker the roots are split over a process pool. `details=False` leaves out
+    the per-route changes and keeps the per-scenario counts.
+    """
+    started = time.perf_counter()
+    topology = Topology.from_lsas(lsas)
+    if roots is None:
+        roots = range(len(topology))
+    else:
+        roots = [topology.index[root] for root in roots]
+    roots = list(roots)
+    workers = max(1, min(workers or os.cpu_count() or 1, len(roots) or 1))
+
+    if workers == 1:
+        _start_worker(topology)
+        batches = [_analyze_roots(roots)]
+    else:
+        # Several chunks per worker even out roots with more work than others.
+        chunk = max(1, len(roots) // (workers * 4))
+        chunks = [roots[i : i + chunk] for i in range(0, len(roots), chunk)]
+        with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_start_worker, initargs=(topology,)
+        ) as pool:
+            batches = list(pool.map(_analyze_roots, chunks))
+
+    ids = topology.ids
+    scenarios = {("link", i, j): [] for i, j in topology.links()}
+    scenarios.update({("node", i): [] for i in range(len(ids))})
+    for batch in batches:
+        for scenario, root, rows in batch:
+            scenarios[scenario].append((root, rows))
+
+    report = []
+    for scenario, affected in scenarios.items():
+        if scenario[0] == "link":
+            entry = {"failure": "link", "link": [ids[scenario[1]], ids[scenario[2]]]}
+        else:
+            entry = {"failure": "node", "router": ids[scenario[1]]}
+        entry["routers_affected"] = len(affected)
+        entry["routes_changed"] = sum(len(rows) for _, rows in affected)
+        entry["routes_lost"] = sum(
+            1 for _, rows in affected for row in rows if row[2] is None
+        )
+        if details:
+            entry["changes"] = [
+                {
+                    "router": root,
+                    "destination": destination,
+                    "cost_before": before,
+                    "cost_after": after,
+                    "cost_delta": None if after is None else after - before,
+                    "next_hops_before": sorted(next_hops_before),
+                    "next_hops_after": sorted(next_hops_after),
+                }
+                for root, rows in affected
+                for destination, before, after, next_hops_before, next_hops_after in rows
+                if before is not None
+            ]
+        report.append(entry)
+    report.sort(key=lambda entry: entry["routes_changed"], reverse=True)
+    return {
+        "routers": len(ids),
+        "links": len(topology.targets) // 2,
+        "roots": len(roots),
+        "workers": workers,
+        "seconds": time.perf_counter() - started,
+        "scenarios": report,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("snapshot", help="LSDB snapshot file written by a node")
+    parser.add_argument(
+        "--roots", type=int, nargs="*", help="only compare these routers' routes"
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--summary", action="store_true", help="leave out the per-route changes"
+    )
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper())
+    saved = load_lsdb(args.snapshot, expire=False)
+    if saved is None:
+        raise SystemExit(f"No valid LSDB snapshot at {args.snapshot}")
+    report = analyze(saved.lsas, args.roots, args.workers, not args.summary)
+    logger.info(
+        "Analyzed %s scenarios in %.2fs", len(report["scenarios"]), report["seconds"]
+    )
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+import itertools
+import zlib
+
+from ip_prefix_tree import IpPrefixTrie
+from metrics import MetricsRegistry
+from shortest_path_first import ShortestPathTree
+
+
+class NextHopGroup:
+    """Equal-cost next hops shared by every prefix that resolves through the
+    same advertising routers.
+
+    Prefixes reference a group by `id`, so when SPF moves the routers the
+    group is updated once in place and every prefix follows.
+    """
+
+    __slots__ = ("id", "routers", "cost", "next_hops", "members", "references")
+
+    def __init__(self, id, routers):
+        self.id = id
+        self.routers = routers
+        self.cost = None
+        self.next_hops = frozenset()
+        self.members = ()
+        self.references = 0
+
+    def __str__(self):
+        return (
+            f"NextHopGroup(id={self.id}, routers={sorted(self.routers)}, "
+            f"cost={self.cost}, next_hops={list(self.members)})"
+        )
+
+    def __repr__(self):
+        return str(self)
+
+    def set(self, cost, next_hops):
+        self.cost = cost
+        self.next_hops = next_hops
+        self.members = tuple(sorted(next_hops))
+
+    def select(self, flow):
+        """Pick one next hop for `flow` (bytes, or any value with a stable repr).
+
+        The same flow always hashes to the same member, so packets of one flow
+        stay on one path while different flows spread over all of them.
+        """
+        if not self.members:
+            return None
+        if not isinstance(flow, (bytes, bytearray, memoryview)):
+            flow = repr(flow).encode()
+        return self.members[zlib.crc32(flow) % len(self.members)]
+
+
+class NextHopGroupTable:
+    """Reference-counted `NextHopGroup`s interned by their set of routers."""
+
+    def __init__(self):
+        self.groups = {}
+        self.by_id = {}
+        self.by_router = {}
+        self.ids = itertools.count()
+
+    def __len__(self):
+        return len(self.groups)
+
+    def acquire(self, routers, cost, next_hops):
+        group = self.groups.get(routers)
+        if group is None:
+            group = self.groups[routers] = NextHopGroup(next(self.ids), routers)
+            self.by_id[group.id] = group
+            for router_id in routers:
+                self.by_router.setdefault(router_id, set()).add(group)
+            group.set(cost, next_hops)
+        group.references += 1
+        return group
+
+    def release(self, group):
+        group.references -= 1
+        if group.references:
+            return
+        del self.groups[group.routers]
+        del self.by_id[group.id]
+        for router_id in group.routers:
+            groups = self.by_router[router_id]
+            groups.discard(group)
+            if not groups:
+                del self.by_router[router_id]
+
+    def containing(self, router_id):
+        return self.by_router.get(router_id, ())
+
+
+class ForwardingTable:
+    """Forwarding table (FIB) of the prefixes routers advertise in their LSAs.
+
+    Each prefix is installed in an `IpPrefixTrie` with the id of the
+    `NextHopGroup` of the closest routers advertising it; equal-cost
+    advertisers share one group with their next hops merged. `update` is fed
+    the same LSA changes as the `ShortestPathTree` plus the destinations SPF
+    reported as changed. When a router's cost or next hops change, only its
+    groups are updated; prefixes are only re-resolved when their advertisers
+    change, a router becomes (un)reachable, or they are advertised by more
+    than one router.
+
+    `cache_size` enables the trie's destination cache for `lookup` and
+    `next_hop`.
+    """
+
+    def __init__(
+        self,
+        spf: ShortestPathTree,
+        metrics: MetricsRegistry = None,
+        cache_size: int = 0,
+    ):
+        self.spf = spf
+        self.trie = IpPrefixTrie(cache_size)
+        self.groups = NextHopGroupTable()
+        # router_id -> prefixes it advertises
+        self.advertised = {}
+        # prefix -> routers advertising it
+        self.originators = {}
+        # router_id -> its prefixes that other routers advertise too
+        self.anycast = {}
+        # prefix -> NextHopGroup currently installed in the trie
+        self.installed = {}
+        metrics = metrics if metrics is not None else MetricsRegistry()
+        self.changes = metrics.counter(
+            "fib_changes_total", "Prefixes installed, moved or removed in the FIB"
+        )
+        self.group_updates = metrics.counter(
+            "fib_group_updates_total", "Next-hop groups updated in place"
+        )
+        metrics.gauge(
+            "fib_prefixes", "Prefixes installed in the FIB", callback=self.__len__
+        )
+        metrics.gauge(
+            "fib_next_hop_groups",
+            "Next-hop groups referenced by the FIB",
+            callback=self.groups.__len__,
+        )
+        metrics.counter(
+            "fib_lookup_cache_hits_total",
+            "FIB lookups answered from the destination cache",
+            callback=lambda: self.trie.cache_hits,
+        )
+        metrics.counter(
+            "fib_lookup_cache_misses_total",
+            "FIB lookups that missed the destination cache",
+            callback=lambda: self.trie.cache_misses,
+        )
+
+    def __len__(self):
+        return len(self.installed)
+
+    def __str__(self):
+        return f"ForwardingTable({self.routes()})"
+
+    def __repr__(self):
+        return str(self)
+
+    def update(self, router_id, link_state_packet, changed_destinations):
+        """Apply the LSA of `router_id` (None when it was removed).
+
+        `changed_destinations` is what `ShortestPathTree.update` returned for
+        the same LSA. Returns the prefixes that moved to another group.
+        """
+        old = self.advertised.get(router_id, frozenset())
+        new = frozenset(link_state_packet.prefixes) if link_state_packet else frozenset()
+        affected = set(old ^ new)
+        if new != old:
+            for prefix in old - new:
+                self._remove_originator(prefix, router_id)
+            for prefix in new - old:
+                self._add_originator(prefix, router_id)
+            if new:
+                self.advertised[router_id] = new
+            else:
+                del self.advertised[router_id]
+
+        for destination in changed_destinations:
+            groups = self.groups.containing(destination)
+            if not groups:
+                # Unreachable until now, or only advertising anycast prefixes
+                # another router wins.
+                affected.update(self.advertised.get(destination, ()))
+                continue
+            for group in groups:
+                route = self._route(group.routers)
+                if route is None:
+                    affected.update(self.advertised.get(destination, ()))
+                elif route != (group.cost, group.next_hops):
+                    group.set(*route)
+                    self.group_updates.inc()
+            affected.update(self.anycast.get(destination, ()))
+
+        changed = set()
+        for prefix in affected:
+            if self._resolve(prefix):
+                changed.add(prefix)
+        self.changes.inc(len(changed))
+        return changed
+
+    def _add_originator(self, prefix, router_id):
+        routers = self.originators.setdefault(prefix, set())
+        routers.add(router_id)
+        if len(routers) == 2:
+            for other in routers:
+                self.anycast.setdefault(other, set()).add(prefix)
+        elif len(routers) > 2:
+            self.anycast.setdefault(router_id, set()).add(prefix)
+
+    def _remove_originator(self, prefix, router_id):
+        routers = self.originators[prefix]
+        routers.discard(router_id)
+        stale = [router_id] if routers else []
+        if len(routers) == 1:
+            stale.extend(routers)
+        elif not routers:
+            del self.originators[prefix]
+        for other in stale:
+            prefixes = self.anycast.get(other)
+            if prefixes is not None:
+                prefixes.discard(prefix)
+                if not prefixes:
+                    del self.anycast[other]
+
+    def _route(self, routers):
+        """Cost and merged next hops of `routers`, None unless all are
+        reachable at the same cost."""
+        cost, next_hops = None, frozenset()
+        for router_id in routers:
+            route = self.spf.route(router_id)
+            if route is None or (cost is not None and route[0] != cost):
+                return None
+            cost, next_hops = route[0], next_hops | route[1]
+        return cost, next_hops
+
+    def _best(self, prefix):
+        best_cost, best_routers = None, []
+        for router_id in self.originators.get(prefix, ()):
+            route = self.spf.route(router_id)
+            if route is None:
+                continue
+            if best_cost is None or route[0] < best_cost:
+                best_cost, best_routers = route[0], [router_id]
+            elif route[0] == best_cost:
+                best_routers.append(router_id)
+        return frozenset(best_routers)
+
+    def _resolve(self, prefix):
+        routers = self._best(prefix)
+        current = self.installed.get(prefix)
+        if current is not None and current.routers == routers:
+            return False
+        if current is not None:
+            self.trie.remove(prefix, current.id)
+            self.groups.release(current)
+        if not routers:
+            if current is None:
+                return False
+            del self.installed[prefix]
+            return True
+        group = self.groups.acquire(routers, *self._route(routers))
+        self.installed[prefix] = group
+        self.trie.insert(prefix, group.id)
+        return True
+
+    def lookup(self, ip):
+        """Longest-prefix match: (prefix, next_hops) for `ip`, or None.
+
+        An empty set of next hops means the prefix is attached to this router.
+        """
+        match = self.trie.search(ip)
+        if match is None:
+            return None
+        _, prefix, group_id = match
+        return prefix, self.groups.by_id[group_id].next_hops
+
+    def next_hop(self, ip, flow):
+        """The one next hop `flow` to `ip` is forwarded to, chosen by flow hash
+        among the equal-cost next hops. None when there is no route or the
+        prefix is attached to this router."""
+        match = self.trie.search(ip)
+        if match is None:
+            return None
+        return self.groups.by_id[match[2]].select(flow)
+
+    def routes(self):
+        return {
+            prefix: (group.cost, group.next_hops)
+            for prefix, group in self.installed.items()
+        }
@@ -1,131 +1,525 @@
+import collections
+import gc
+import json
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+
+try:
+    import numpy as np
+except ImportError:  # search_many falls back to bisect
+    np = None
+
+
+def search_flattened(starts, prefix_lens, indexes, addresses):
+    """Longest-prefix match of `addresses` against flattened trie arrays."""
+    if np is not None:
+        if isinstance(addresses, np.ndarray):
+            addresses = addresses.astype(np.uint32, copy=False)
+        elif isinstance(addresses, (bytes, bytearray, memoryview)):
+            addresses = np.frombuffer(addresses, dtype=">u4")
+        else:
+            addresses = np.fromiter(addresses, dtype=np.uint32)
+        positions = np.searchsorted(
+            np.frombuffer(starts, dtype=np.uint32), addresses, side="right"
+        )
+        positions -= 1
+        return (
+            np.frombuffer(prefix_lens, dtype=np.int8)[positions],
+            np.frombuffer(indexes, dtype=np.int32)[positions],
+        )
+
+    if isinstance(addresses, (bytes, bytearray, memoryview)):
+        packed = array("I", bytes(addresses))
+        if sys.byteorder == "little":
+            packed.byteswap()
+        addresses = packed
+    matched_lens, matched_indexes = array("b"), array("i")
+    for address in addresses:
+        position = bisect_right(starts, address) - 1
+        matched_lens.append(prefix_lens[position])
+        matched_indexes.append(indexes[position])
+    return matched_lens, matched_indexes
+
+
 class IpPrefixTrie:
+    """Path-compressed binary trie (Patricia trie) of IPv4 prefixes.
+
+    Prefixes are keyed on 32-bit integers. Every node stores one prefix and
+    only branches where two stored prefixes diverge, so inserts, removals and
+    lookups walk at most one node per prefix bit.
+
+    With `cache_size` set, `search` keeps the results for that many recently
+    looked up addresses in an LRU cache. Cached results are indexed by the
+    route they matched: inserting a prefix only drops the cached addresses it
+    covers that matched a shorter prefix, and removing one only drops the
+    addresses that matched it.
+    """
+
     class Node:
-        def __init__(self):
-            self.children = {}
-            self.prefix_len = None
-            self.route_name = None
+        __slots__ = ("key", "prefix_len", "children", "cidr", "routes", "index")
+
+        def __init__(self, key, prefix_len):
+            self.key = key
+            self.prefix_len = prefix_len
+            self.children = [None, None]
             self.cidr = None
-            self.routes = set()
+            self.index = None
+            # route_name -> None, kept in insertion order; the first one wins
+            self.routes = {}
+
+        @property
+        def route_name(self):
+            return next(iter(self.routes))
 
-    def __init__(self):
-        self.root = self.Node()
+    def __init__(self, cache_size: int = 0):
+        self.root = self.Node(0, 0)
+        self.size = 0
+        self.by_index = {}
+        self.next_index = 0
+        self.flattened = None
+        self.cache_size = cache_size
+        # ip -> (address, route index or -1, search result), oldest first
+        self.cache = collections.OrderedDict() if cache_size else None
+        # route index or -1 -> ips whose cached result is that route
+        self.cached_by_route = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def __len__(self):
+        return self.size
 
     @staticmethod
-    def enumerate_ending_addresses(network, mask):
+    def ip_to_int(ip):
+        a, b, c, d = ip.split(".")
+        return (int(a) << 24) | (int(b) << 16) | (int(c) << 8) | int(d)
 
-        # Convert the network address to an integer
-        network_parts = network.split('.')
-        network_int = sum(int(octet) << (24 - 8 * i) for i, octet in enumerate(network_parts))
+    @staticmethod
+    def int_to_ip(value):
+        return f"{value >> 24 & 0xFF}.{value >> 16 & 0xFF}.{value >> 8 & 0xFF}.{value & 0xFF}"
 
-        # Calculate the number of addresses in the subnet
-        num_addresses = 2 ** (32 - mask)
+    @staticmethod
+    def parse_prefix(ip_prefix):
+        """Return (network, prefix length) of a CIDR such as "10.0.1.0/24".
 
-        # Generate all addresses in the subnet
-        for i in range(num_addresses):
-            yield network_int + i
+        Raises ValueError for anything else, including octets above 255.
+        """
+        try:
+            network, mask = ip_prefix.split("/")
+            a, b, c, d = network.split(".")
+            a, b, c, d, mask = int(a), int(b), int(c), int(d), int(mask)
+        except (AttributeError, ValueError):
+            raise ValueError(f"Invalid prefix {ip_prefix!r}") from None
+        # Also catches negative octets
+        if (a | b | c | d) & ~0xFF:
+            raise ValueError(f"Invalid network address in {ip_prefix}")
+        if not 0 <= mask <= 32:
+            raise ValueError(f"Invalid prefix length in {ip_prefix}")
+        return ((a << 24) | (b << 16) | (c << 8) | d) & IpPrefixTrie.mask(mask), mask
 
     @staticmethod
-    def prefix_to_closest_oct(prefix, mask):
-        # Convert the prefix to an integer
-        prefix_parts = prefix.split('.')
-        prefix_int = sum(int(octet) << (24 - 8 * i) for i, octet in enumerate(prefix_parts))
-
-        # Calculate the number of addresses in the subnet
-        octet = mask // 8
-        if mask % 8 == 0 and mask != 0:
-            octet -= 1
-
-        # Generate all addresses in the subnet
-        for i in range(4):
-            if i == octet:
-                # we need to iterate through all prefixes between the start of the mask
-                # and the next nearest multiple of 8
-                mask_num = (prefix_int >> (24 - 8 * i)) & 0xFF
-                parts = []
-                for j in range(2 ** ((8 * (octet + 1)) - mask)):
-                    # print(f"Octet {i} is the closest octet to the mask")
-                    parts.append(mask_num + j)
-                yield parts
-                break
-            else:
-                # print(f"Octet {i} is not the closest octet to the mask")
-                yield prefix_int >> (24 - 8 * i) & 0xFF
+    def normalize_prefix(ip_prefix):
+        """Return `ip_prefix` with its host bits cleared, e.g. "10.0.1.0/24"."""
+        return IpPrefixTrie.format_prefix(*IpPrefixTrie.parse_prefix(ip_prefix))
 
-        # return [prefix_int + i for i in range(num_addresses)]
+    @staticmethod
+    def format_prefix(key, prefix_len):
+        return f"{IpPrefixTrie.int_to_ip(key)}/{prefix_len}"
+
+    @staticmethod
+    def mask(prefix_len):
+        return (0xFFFFFFFF << (32 - prefix_len)) & 0xFFFFFFFF
+
+    @staticmethod
+    def bit(key, index):
+        return (key >> (31 - index)) & 1
+
+    @staticmethod
+    def common_prefix_len(a, b):
+        return 32 - (a ^ b).bit_length()
+
+    def _insert_node(self, key, prefix_len, node=None):
+        # `node` must cover the new prefix; the walk starts there.
+        if node is None:
+            node = self.root
+        while node.prefix_len != prefix_len:
+            branch = self.bit(key, node.prefix_len)
+            child = node.children[branch]
+            if child is None:
+                child = node.children[branch] = self.Node(key, prefix_len)
+                return child
+            common = min(
+                self.common_prefix_len(key, child.key), prefix_len, child.prefix_len
+            )
+            if common == child.prefix_len:
+                node = child
+                continue
+            if common == prefix_len:
+                new = node.children[branch] = self.Node(key, prefix_len)
+                new.children[self.bit(child.key, prefix_len)] = child
+                return new
+            glue = node.children[branch] = self.Node(key & self.mask(common), common)
+            glue.children[self.bit(child.key, common)] = child
+            new = glue.children[self.bit(key, common)] = self.Node(key, prefix_len)
+            return new
+        return node
 
     def insert(self, ip_prefix, route_name=None):
-        route = (ip_prefix, route_name)
-        parts = ip_prefix.split('/')
-        network, mask = parts[0], int(parts[1])
-        node = self.root
-        for part in self.prefix_to_closest_oct(network, mask):
-            if type(part) is not list:
-                if part not in node.children:
-                    node.children[part] = self.Node()
-
-                node = node.children[part]
-            else:
-                for prefix in part:
-                    if prefix not in node.children:
-                        match = self.Node()
-                        match.prefix_len = mask
-                        match.route_name = route_name
-                        node.children[prefix] = match
-                        node.children[prefix].cidr = ip_prefix
-                        node.children[prefix].routes.add(route)
-                    else:
-                        node.children[prefix].routes.add(route)
-                        if node.children[prefix].prefix_len is None or node.children[prefix].prefix_len < mask:
-                            node.children[prefix].prefix_len = mask
-                            node.children[prefix].route_name = route_name
-                            node.children[prefix].cidr = ip_prefix
+        key, prefix_len = self.parse_prefix(ip_prefix)
+        self._add_route(self._insert_node(key, prefix_len), ip_prefix, route_name)
+
+    def _add_route(self, node, cidr, route_name):
+        if not node.routes:
+            if self.cache:
+                self._invalidate(
+                    self._covering_index(node.key, node.prefix_len),
+                    node.key,
+                    node.prefix_len,
+                )
+            node.cidr = cidr
+            node.index = self.next_index
+            self.by_index[node.index] = node
+            self.next_index += 1
+            self.size += 1
+            self.flattened = None
+        node.routes[route_name] = None
+
+    def bulk_load(self, prefixes):
+        """Insert many `(key, prefix_len[, route_name])` tuples in one pass.
+
+        Keys are integer network addresses. When the prefixes come sorted by
+        (key, prefix_len), each one is inserted starting from its closest
+        already inserted ancestor, so the whole load is close to linear and no
+        strings are parsed. Unsorted input is still inserted correctly, just
+        with longer walks.
+        """
+        # Node allocation would otherwise trigger a full collection every few
+        # thousand inserts, each rescanning the whole trie.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self._bulk_load(prefixes)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _bulk_load(self, prefixes):
+        # Nodes, glue included, on the path from the root to the last prefix
+        path = [self.root]
+        for prefix in prefixes:
+            key, prefix_len = prefix[0], prefix[1]
+            route_name = prefix[2] if len(prefix) > 2 else None
+            if not 0 <= prefix_len <= 32:
+                raise ValueError(f"Invalid prefix length {prefix_len}")
+            key &= self.mask(prefix_len)
+            while len(path) > 1 and (
+                path[-1].prefix_len > prefix_len
+                or (key ^ path[-1].key) >> (32 - path[-1].prefix_len)
+            ):
+                path.pop()
+            node = path[-1]
+            target = self._insert_node(key, prefix_len, node)
+            # The new node is at most a glue node below the top of the path.
+            while node is not target:
+                node = node.children[(key >> (31 - node.prefix_len)) & 1]
+                path.append(node)
+            self._add_route(target, self.format_prefix(key, prefix_len), route_name)
+
+    @staticmethod
+    def read_prefixes(lines):
+        """Yield `(key, prefix_len, route_name)` from lines of "cidr [route]"
+        text, such as an open routing table dump, for `bulk_load`."""
+        for line in lines:
+            fields = line.split(None, 1)
+            if not fields or fields[0].startswith("#"):
+                continue
+            key, prefix_len = IpPrefixTrie.parse_prefix(fields[0])
+            route_name = fields[1].strip() if len(fields) > 1 else None
+            yield key, prefix_len, route_name
 
     def remove(self, ip_prefix, route_name):
-        node = self.root
-        parts = ip_prefix.split('/')
-        network, mask = parts[0], int(parts[1])
-        potential_matches = []
-        for part in self.prefix_to_closest_oct(network, mask):
-            if type(part) is not list:
-                if part not in node.children:
-                    return
-                node = node.children[part]
-                potential_matches.append(node)
-            else:
-                for prefix in part:
-                    if prefix not in node.children:
-                        return
-                    match = node.children[prefix]
-                    match.routes.remove((ip_prefix, route_name))
-                    prefix_len = -1
-                    for r in match.routes:
-                        if r[1] is not None:
-                            prefix_len = max(prefix_len, int(r[0].split('/')[1]))
-                            match.prefix_len = prefix_len
-                            match.route_name = r[1]
-                            match.cidr = r[0]
-
-        for match in reversed(potential_matches):
-            to_delete = []
-            for key, value in match.children.items():
-                if not value.routes and not value.children:
-                    to_delete.append(key)
-            for key in to_delete:
-                match.children.pop(key)
+        key, prefix_len = self.parse_prefix(ip_prefix)
+        node, parent, grandparent = self.root, None, None
+        while node is not None and node.prefix_len < prefix_len:
+            grandparent, parent = parent, node
+            node = node.children[self.bit(key, node.prefix_len)]
+        if node is None or node.prefix_len != prefix_len or node.key != key:
+            return
+        if route_name not in node.routes:
+            return
+        if self.cache and route_name == node.route_name:
+            self._invalidate(node.index)
+        del node.routes[route_name]
+        if node.routes:
+            return
+        node.cidr = None
+        del self.by_index[node.index]
+        node.index = None
+        self.size -= 1
+        self.flattened = None
+        if node is self.root:
+            return
+
+        # Drop the now empty node, then the glue node above it if that one is
+        # left with a single child.
+        remaining = [child for child in node.children if child is not None]
+        if len(remaining) == 2:
+            return
+        parent.children[parent.children.index(node)] = (
+            remaining[0] if remaining else None
+        )
+        if parent is self.root or parent.routes:
+            return
+        remaining = [child for child in parent.children if child is not None]
+        if len(remaining) == 1:
+            grandparent.children[grandparent.children.index(parent)] = remaining[0]
 
     def search(self, ip):
+        cache = self.cache
+        if cache is not None:
+            entry = cache.get(ip)
+            if entry is not None:
+                cache.move_to_end(ip)
+                self.cache_hits += 1
+                return entry[2]
+            self.cache_misses += 1
+        address = self.ip_to_int(ip)
+        best = None
         node = self.root
-        for addr in self.enumerate_ending_addresses(ip, 32):
-            best_match = -1, None, None
-            for i in range(4):
-                char = (addr >> (24 - 8 * i)) & 0xFF
-                if char not in node.children:
-                    break
-
-                node = node.children[char]
-                if node.prefix_len is not None and node.prefix_len > best_match[0]:
-                    best_match = node.prefix_len, node.cidr, node.route_name,
-
-            if best_match[0] != -1:
-                return best_match
-        return None
+        while node is not None:
+            if (address ^ node.key) >> (32 - node.prefix_len):
+                break
+            if node.routes:
+                best = node
+            if node.prefix_len == 32:
+                break
+            node = node.children[self.bit(address, node.prefix_len)]
+        if best is None:
+            result, index = None, -1
+        else:
+            result = best.prefix_len, best.cidr, best.route_name
+            index = best.index
+        if cache is not None:
+            if len(cache) >= self.cache_size:
+                evicted, (_, evicted_index, _) = cache.popitem(last=False)
+                self._forget(evicted, evicted_index)
+            cache[ip] = address, index, result
+            self.cached_by_route.setdefault(index, set()).add(ip)
+        return result
+
+    def cache_info(self):
+        """Hit and miss counts and occupancy of the lookup cache."""
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "size": len(self.cache) if self.cache is not None else 0,
+            "max_size": self.cache_size,
+        }
+
+    def _covering_index(self, key, prefix_len):
+        """Route index of the longest prefix shorter than `prefix_len` that
+        covers `key`, or -1 if there is none."""
+        index = -1
+        node = self.root
+        while node is not None and node.prefix_len < prefix_len:
+            if (key ^ node.key) >> (32 - node.prefix_len):
+                break
+            if node.routes:
+                index = node.index
+            node = node.children[self.bit(key, node.prefix_len)]
+        return index
+
+    def _forget(self, ip, index):
+        ips = self.cached_by_route[index]
+        ips.discard(ip)
+        if not ips:
+            del self.cached_by_route[index]
+
+    def _invalidate(self, index, key=0, prefix_len=0):
+        """Drop cached results that matched route `index` (-1: no route) for
+        addresses inside key/prefix_len."""
+        ips = self.cached_by_route.get(index)
+        if not ips:
+            return
+        if prefix_len:
+            stale = [
+                ip
+                for ip in ips
+                if not (self.cache[ip][0] ^ key) >> (32 - prefix_len)
+            ]
+        else:
+            stale = list(ips)
+        for ip in stale:
+            del self.cache[ip]
+            self._forget(ip, index)
+
+    def route(self, index):
+        """Return the (prefix_len, cidr, route_name) of a route index."""
+        node = self.by_index[index]
+        return node.prefix_len, node.cidr, node.route_name
+
+    def flatten(self):
+        """Encode the trie as sorted, non-overlapping address ranges.
+
+        Returns three parallel arrays: the first address of each range, and the
+        prefix length and route index (-1 for none) of its longest match. The
+        result is cached until the next insert or remove.
+        """
+        if self.flattened is not None:
+            return self.flattened
+        starts, prefix_lens, indexes = array("I"), array("b"), array("i")
+
+        def emit(start, best):
+            if starts and starts[-1] == start:
+                starts.pop()
+                prefix_lens.pop()
+                indexes.pop()
+            if prefix_lens and (prefix_lens[-1], indexes[-1]) == best:
+                return
+            starts.append(start)
+            prefix_lens.append(best[0])
+            indexes.append(best[1])
+
+        def walk(node, best):
+            if node.routes:
+                best = node.prefix_len, node.index
+            emit(node.key, best)
+            for child in node.children:
+                if child is not None:
+                    walk(child, best)
+                    end = child.key + (1 << (32 - child.prefix_len))
+                    if end <= 0xFFFFFFFF:
+                        emit(end, best)
+
+        walk(self.root, (-1, -1))
+        self.flattened = starts, prefix_lens, indexes
+        return self.flattened
+
+    def search_many(self, addresses):
+        """Longest-prefix match for a batch of addresses.
+
+        `addresses` is a NumPy integer array, a buffer of packed big-endian
+        (network order) 32-bit addresses, or an iterable of integers. Returns
+        arrays of matched prefix lengths and route indexes, both -1 where
+        nothing matches; see `route` to resolve an index. Uses NumPy when it is
+        installed and a bisect loop over the flattened trie otherwise.
+        """
+        return search_flattened(*self.flatten(), addresses)
+
+    def freeze(self, path):
+        """Write the flattened trie as a read-only image for `FrozenIpPrefixTrie`.
+
+        Route names must be JSON serializable. Route indexes in the image are
+        renumbered densely and so differ from the ones `search_many` returns
+        on this trie.
+        """
+        starts, prefix_lens, indexes = self.flatten()
+        renumbered = {}
+        routes = []
+        dense = array("i")
+        for index in indexes:
+            if index >= 0 and index not in renumbered:
+                node = self.by_index[index]
+                renumbered[index] = len(routes)
+                routes.append([node.cidr, node.route_name])
+            dense.append(renumbered.get(index, -1))
+        blobs = [json.dumps(route).encode() for route in routes]
+        offsets = array("I", [0])
+        for blob in blobs:
+            offsets.append(offsets[-1] + len(blob))
+
+        sections = [array("I", starts), array("b", prefix_lens), dense, offsets]
+        if sys.byteorder == "big":
+            for section in sections:
+                section.byteswap()
+        with open(path, "wb") as image:
+            image.write(
+                FROZEN_HEADER.pack(FROZEN_MAGIC, FROZEN_VERSION, len(starts), len(routes))
+            )
+            for section in sections:
+                data = section.tobytes()
+                image.write(data)
+                image.write(bytes(-len(data) % 4))
+            image.write(b"".join(blobs))
+
+
+# magic, version, number of ranges, number of routes; all sections little-endian
+FROZEN_HEADER = struct.Struct("<4sHxxII")
+FROZEN_MAGIC = b"IPFT"
+FROZEN_VERSION = 1
+
+
+class FrozenIpPrefixTrie:
+    """Read-only longest-prefix-match table searched straight from an image
+    written by `IpPrefixTrie.freeze`.
+
+    The file is mapped, not read: opening it costs the same for any table
+    size, and processes that open the same image share its pages.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as image:
+            self.mapped = mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, route_count = FROZEN_HEADER.unpack_from(self.mapped)
+        if magic != FROZEN_MAGIC or version != FROZEN_VERSION:
+            self.mapped.close()
+            raise ValueError(f"{path} is not a frozen IpPrefixTrie image")
+        self.size = route_count
+        view = memoryview(self.mapped)
+        offset = FROZEN_HEADER.size
+        sections = []
+        layout = (("I", count), ("b", count), ("i", count), ("I", route_count + 1))
+        for typecode, length in layout:
+            end = offset + length * struct.calcsize(typecode)
+            section = view[offset:end].cast(typecode)
+            if sys.byteorder == "big":
+                section = array(typecode, section)
+                section.byteswap()
+            sections.append(section)
+            offset = end + (-end % 4)
+        self.starts, self.prefix_lens, self.indexes, self.offsets = sections
+        self.blobs = view[offset:]
+        self.routes = {}
+
+    def __len__(self):
+        return self.size
+
+    def close(self):
+        sections = (self.starts, self.prefix_lens, self.indexes, self.offsets, self.blobs)
+        for section in sections:
+            if isinstance(section, memoryview):
+                section.release()
+        self.mapped.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def route(self, index):
+        """Return the (prefix_len, cidr, route_name) of a route index."""
+        route = self.routes.get(index)
+        if route is None:
+            cidr, route_name = json.loads(
+                bytes(self.blobs[self.offsets[index]:self.offsets[index + 1]])
+            )
+            route = self.routes[index] = (
+                int(cidr.rsplit("/", 1)[1]),
+                cidr,
+                route_name,
+            )
+        return route
+
+    def search(self, ip):
+        position = bisect_right(self.starts, IpPrefixTrie.ip_to_int(ip)) - 1
+        index = self.indexes[position]
+        if index < 0:
+            return None
+        return self.route(index)
+
+    def search_many(self, addresses):
+        """Same as `IpPrefixTrie.search_many`, over the mapped image."""
+        return search_flattened(self.starts, self.prefix_lens, self.indexes, addresses)
@@ -1,7 +1,25 @@
-import asyncio
+import math
+import time
+from array import array
+from collections.abc import Mapping, Sequence
+from types import MappingProxyType
+
+from ip_prefix_tree import IpPrefixTrie
+from metrics import MetricsRegistry
+from timer_heap import DeadlineHeap
+
+
+# Every router id seen, so the LSDB, SPF and FIB all share one object per id
+# instead of holding a fresh int for it from every decoded LSA.
+ROUTER_IDS = {}
+
+
+def intern_id(router_id):
+    return ROUTER_IDS.setdefault(router_id, router_id)
 
 
 class Link:
+    __slots__ = ("link_id", "cost")
 
     def __init__(self, link_id: str, cost: int):
         self.link_id = link_id
@@ -17,7 +35,75 @@ class Link:
         return {"link_id": self.link_id, "cost": self.cost}
 
 
+class Links(Sequence):
+    """The links of an LSA, packed as link_id, cost pairs into one array.
+
+    Indexing and iterating build `Link` objects on the fly; `pairs` yields
+    the (link_id, cost) tuples without them. Ids that do not fit a signed
+    64-bit integer are kept in a plain list with the same layout.
+    """
+
+    __slots__ = ("packed",)
+
+    def __init__(self, links=()):
+        flat = []
+        for link in links:
+            flat.append(link.link_id)
+            flat.append(link.cost)
+        self.packed = Links.pack(flat)
+
+    @staticmethod
+    def pack(flat):
+        try:
+            return array("q", flat)
+        except (TypeError, OverflowError):
+            return list(flat)
+
+    @classmethod
+    def from_packed(cls, packed):
+        links = cls.__new__(cls)
+        links.packed = packed
+        return links
+
+    def __len__(self):
+        return len(self.packed) // 2
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("link index out of range")
+        return Link(intern_id(self.packed[2 * index]), self.packed[2 * index + 1])
+
+    def __iter__(self):
+        for link_id, cost in self.pairs():
+            yield Link(link_id, cost)
+
+    def __str__(self):
+        return str(list(self))
+
+    def __repr__(self):
+        return str(self)
+
+    def pairs(self):
+        packed = self.packed
+        for i in range(0, len(packed), 2):
+            yield intern_id(packed[i]), packed[i + 1]
+
+
 class LinkStatePacket:
+    __slots__ = (
+        "router_id",
+        "sequence_number",
+        "link_state_id",
+        "_links",
+        "_ttl",
+        "expires_at",
+        "prefixes",
+    )
+
     def __init__(
         self,
         router_id: int,
@@ -25,17 +111,42 @@ class LinkStatePacket:
         link_state_id: int,
         links: [Link],
         ttl: int,
+        prefixes: [str] = None,
     ):
-        self.router_id = router_id
+        self.router_id = intern_id(router_id)
         self.sequence_number = sequence_number
-        self.link_state_id = link_state_id
+        self.link_state_id = intern_id(link_state_id)
         self.links = links
         self.ttl = ttl
+        # CIDRs attached to the router, such as "10.0.1.0/24"
+        self.prefixes = tuple(prefixes) if prefixes else ()
+
+    @property
+    def links(self) -> Links:
+        return self._links
+
+    @links.setter
+    def links(self, links):
+        self._links = links if isinstance(links, Links) else Links(links)
+
+    @property
+    def ttl(self):
+        # Once stored, an LSA ages against its absolute expiry time instead of
+        # having its ttl decremented in place.
+        if self.expires_at is None:
+            return self._ttl
+        return max(0, math.ceil(self.expires_at - time.monotonic()))
+
+    @ttl.setter
+    def ttl(self, ttl):
+        self._ttl = ttl
+        self.expires_at = None
 
     def __str__(self):
         return (
             f"LinkStatePacket(router_id={self.router_id}, sequence_number={self.sequence_number}, "
-            f"link_state_id={self.link_state_id}, links={self.links}, ttl={self.ttl})"
+            f"link_state_id={self.link_state_id}, links={self.links}, "
+            f"prefixes={self.prefixes}, ttl={self.ttl})"
         )
 
     def __repr__(self):
@@ -48,6 +159,23 @@ class LinkStatePacket:
             and self.link_state_id == other.link_state_id
         )
 
+    def replace(self, **changes):
+        """Return a copy of this packet with the given fields changed.
+
+        Packets stored in a LinkStateDatabase are shared with its snapshots and
+        must not be modified in place; build a new one with this instead.
+        """
+        fields = {
+            "router_id": self.router_id,
+            "sequence_number": self.sequence_number,
+            "link_state_id": self.link_state_id,
+            "links": self.links,
+            "ttl": self.ttl,
+            "prefixes": self.prefixes,
+        }
+        fields.update(changes)
+        return LinkStatePacket(**fields)
+
     def __ne__(self, other):
         return not self.__eq__(other)
 
@@ -60,54 +188,137 @@ class LinkStatePacket:
             "sequence_number": self.sequence_number,
             "link_state_id": self.link_state_id,
             "links": [link.to_dict() for link in self.links],
+            "prefixes": list(self.prefixes),
             "ttl": self.ttl,
         }
 
     @staticmethod
     def from_dict(data):
+        """Build a packet from an LSA dict, as received in a JSON message.
+
+        Raises ValueError for a prefix that is not a CIDR, so a bad LSA is
+        refused before it can reach the LSDB.
+        """
+        links = data["links"]
+        if not isinstance(links, Links):
+            flat = []
+            for link in links:
+                flat.append(link["link_id"])
+                flat.append(link["cost"])
+            links = Links.from_packed(Links.pack(flat))
         return LinkStatePacket(
             data["router_id"],
             data["sequence_number"],
             data["link_state_id"],
-            [Link(link["link_id"], link["cost"]) for link in data["links"]],
+            links,
             data["ttl"],
+            [IpPrefixTrie.normalize_prefix(prefix) for prefix in data.get("prefixes") or ()],
         )
 
 
+class LsdbSnapshot(Mapping):
+    """Read-only view of a LinkStateDatabase at one generation.
+
+    A snapshot never changes after it is taken; later writes to the database
+    go to a new dict and show up in the next snapshot.
+    """
+
+    def __init__(self, generation, database):
+        self.generation = generation
+        self.database = MappingProxyType(database)
+
+    def __getitem__(self, link_id):
+        return self.database[link_id]
+
+    def __iter__(self):
+        return iter(self.database)
+
+    def __len__(self):
+        return len(self.database)
+
+    def __str__(self):
+        return f"LsdbSnapshot(generation={self.generation}, {dict(self.database)})"
+
+    def __repr__(self):
+        return str(self)
+
+
 class LinkStateDatabase:
-    def __init__(self):
+    """Link state packets keyed by link_state_id.
+
+    Readers never lock or copy: `snapshot` hands out the current dict behind an
+    immutable, generation-numbered view. Writers copy the dict only when the
+    current one has been handed out (copy-on-write), then publish the change
+    by bumping the generation.
+    """
+
+    def __init__(self, metrics: MetricsRegistry = None):
         self.database = {}
-        self.database_lock = asyncio.Lock()
-        asyncio.create_task(self.handle_decrement())
+        self.generation = 0
+        self.published = LsdbSnapshot(0, self.database)
+        self.subscribers = []
+        self.expirations = DeadlineHeap(self._expire)
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.expired_lsas = self.metrics.counter(
+            "lsdb_expirations_total", "LSAs removed because their ttl ran out"
+        )
+        self.metrics.gauge(
+            "lsdb_entries", "LSAs in the link state database", callback=self.__len__
+        )
+
+    def subscribe(self, callback):
+        """Call `callback(link_id, link_state_packet)` after every change.
+
+        The packet is None when the entry was removed or expired.
+        """
+        self.subscribers.append(callback)
+
+    def _notify(self, link_id, link_state_packet):
+        for callback in self.subscribers:
+            callback(link_id, link_state_packet)
+
+    def _writable(self):
+        if self.published is not None:
+            self.database = dict(self.database)
+            self.published = None
+        self.generation += 1
+        return self.database
+
+    def snapshot(self) -> LsdbSnapshot:
+        if self.published is None:
+            self.published = LsdbSnapshot(self.generation, self.database)
+        return self.published
 
     async def add(self, link_id, link_state_packet: LinkStatePacket):
-        async with self.database_lock:
-            self.database[link_id] = link_state_packet
+        expires_at = time.monotonic() + link_state_packet.ttl
+        link_state_packet.expires_at = expires_at
+        self._writable()[link_id] = link_state_packet
+        self.expirations.schedule(link_id, expires_at)
+        self._notify(link_id, link_state_packet)
 
     async def get(self, link_id) -> LinkStatePacket:
-        async with self.database_lock:
-            return self.database.get(link_id)
+        return self.database.get(link_id)
 
     async def remove(self, link_id):
-        async with self.database_lock:
-            self.database.pop(link_id, None)
-
-    async def get_all(self):
-        async with self.database_lock:
-            return self.database.copy()
-
-    async def handle_decrement(self):
-        while True:
-            await asyncio.sleep(1)
-            async with self.database_lock:
-                keys_to_delete = []
-                for key in list(self.database.keys()):
-                    if self.database[key].ttl == 0:
-                        keys_to_delete.append(key)
-                    else:
-                        self.database[key].ttl -= 1
-                for key in keys_to_delete:
-                    self.database.pop(key, None)
+        self.expirations.cancel(link_id)
+        if link_id in self.database:
+            del self._writable()[link_id]
+            self._notify(link_id, None)
+
+    async def get_all(self) -> LsdbSnapshot:
+        return self.snapshot()
+
+    def _expire(self, link_id):
+        if link_id in self.database:
+            self.expired_lsas.inc()
+            del self._writable()[link_id]
+            self._notify(link_id, None)
+
+    def close(self):
+        self.expirations.close()
+
+    def __len__(self):
+        return len(self.database)
 
     def __str__(self):
         return str(self.database)
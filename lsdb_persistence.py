@@ -0,0 +1,164 @@
+"""Crash-consistent LSDB snapshot files for warm restarts.
+
+A snapshot is a fixed header followed by the LSAs as binary LSA records (the
+same layout `wire_protocol` puts on the wire):
+
+    magic "LSDB", version, router id, reserved sequence number,
+    wall-clock time written, record count, payload length, payload crc32
+
+Files are written to a temporary file, fsynced and renamed over the old one,
+so a crash leaves either the previous or the new snapshot, never a torn one.
+Loading maps the file and decodes the records in place; a file that is
+truncated or fails its checksum is ignored.
+
+The reserved sequence number is a high-water mark for the router's own LSAs:
+a node never originates a sequence number above the one recorded on disk, so
+after a restart it can resume above it without reusing numbers it may
+already have flooded.
+"""
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+from wire_protocol import decode_lsa, encode_lsa
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"LSDB"
+VERSION = 1
+HEADER = struct.Struct("!4sHqqdIII")
+# Sequence numbers reserved by each snapshot write that raises the mark
+SEQUENCE_BLOCK = 1024
+
+
+class SavedLsdb:
+    def __init__(self, router_id, sequence_reserved, written_at, lsas):
+        self.router_id = router_id
+        self.sequence_reserved = sequence_reserved
+        self.written_at = written_at
+        # LSA dicts whose ttl has been reduced by the time since written_at
+        self.lsas = lsas
+
+    def __str__(self):
+        return (
+            f"SavedLsdb(router_id={self.router_id}, "
+            f"sequence_reserved={self.sequence_reserved}, lsas={len(self.lsas)})"
+        )
+
+    def __repr__(self):
+        return str(self)
+
+
+def save_lsdb(path, router_id, lsas, sequence_reserved):
+    """Atomically replace `path` with a snapshot of the LinkStatePackets in
+    `lsas` (for example `LinkStateDatabase.snapshot().values()`).
+
+    LSAs the record format cannot hold (ids beyond 64 bits) are left out; a
+    warm restart learns them again from the neighbors.
+    """
+    records = []
+    skipped = 0
+    for lsa in lsas:
+        try:
+            records.append(encode_lsa(lsa.to_dict()))
+        except (TypeError, ValueError, struct.error):
+            skipped += 1
+    if skipped:
+        logger.warning("Left %s LSAs that cannot be encoded out of %s", skipped, path)
+    payload = b"".join(records)
+    header = HEADER.pack(
+        MAGIC,
+        VERSION,
+        router_id,
+        sequence_reserved,
+        time.time(),
+        len(records),
+        len(payload),
+        zlib.crc32(payload),
+    )
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix=".lsdb-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(header)
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.unlink(temporary)
+        raise
+    # Persist the rename itself; not every platform can fsync a directory.
+    try:
+        directory_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(directory_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(directory_fd)
+
+
+def load_lsdb(path, now=None, expire=True) -> SavedLsdb:
+    """Read the snapshot at `path`, or return None if it is missing or invalid.
+
+    LSAs whose ttl ran out since the snapshot was written are left out, unless
+    `expire` is False; then every LSA is returned as it was written.
+    """
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with file:
+        if os.fstat(file.fileno()).st_size < HEADER.size:
+            logger.warning("Ignoring truncated LSDB snapshot %s", path)
+            return None
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                if not expire:
+                    now = -math.inf
+                elif now is None:
+                    now = time.time()
+                return _decode(path, view, now)
+            finally:
+                view.release()
+
+
+def _decode(path, view, now):
+    (
+        magic,
+        version,
+        router_id,
+        sequence_reserved,
+        written_at,
+        count,
+        length,
+        checksum,
+    ) = HEADER.unpack_from(view)
+    if magic != MAGIC or version != VERSION:
+        logger.warning("Ignoring %s: not an LSDB snapshot", path)
+        return None
+    payload = view[HEADER.size:]
+    if len(payload) != length or zlib.crc32(payload) != checksum:
+        payload.release()
+        logger.warning("Ignoring corrupt LSDB snapshot %s", path)
+        return None
+    payload.release()
+
+    age = max(0.0, now - written_at)
+    lsas, offset = [], HEADER.size
+    for _ in range(count):
+        lsa, offset = decode_lsa(view, offset)
+        lsa["ttl"] = int(lsa["ttl"] - age)
+        if lsa["ttl"] > 0:
+            lsas.append(lsa)
+    return SavedLsdb(router_id, sequence_reserved, written_at, lsas)
@@ -1,103 +1,484 @@
 import asyncio
-import json
+import logging
 import random
+import struct
+import time
+from duplicate_filter import DuplicateFilter
+from fib import ForwardingTable
+from ip_prefix_tree import IpPrefixTrie
 from link_state_database import LinkStatePacket, LinkStateDatabase, Link
+from lsdb_persistence import SEQUENCE_BLOCK, load_lsdb, save_lsdb
+from metrics import MetricsRegistry, serve as serve_metrics
+from send_queue import NeighborQueue
+from shortest_path_first import ShortestPathTree
+from throttle import Throttle
+from timer_heap import DeadlineHeap
+from tracing import TraceRecorder
+from transport import TcpTransport
+from wire_protocol import (
+    BINARY,
+    CONTINUED,
+    DB_SUMMARY,
+    JSON,
+    MAX_JOINED_ENTRIES,
+    SPLIT_FIELDS,
+    EncodedLsa,
+    decode_frame,
+    read_frame,
+    to_packet,
+)
+
+logger = logging.getLogger(__name__)
 
 
 class LinkStateNode:
 
-    def __init__(self, id: int):
+    def __init__(
+        self,
+        id: int,
+        wire_format: str = JSON,
+        flood_pacing: float = 0.02,
+        transport=None,
+        hello_interval: float = 15,
+        dead_interval: float = None,
+        lsa_interval: float = 30,
+        max_queued_lsas: int = 1024,
+        max_queued_messages: int = 64,
+        snapshot_path: str = None,
+        snapshot_interval: float = 30,
+        fib_cache_size: int = 0,
+        lsa_min_hold: float = 0.05,
+        lsa_max_hold: float = 5.0,
+        spf_min_hold: float = 0.01,
+        spf_max_hold: float = 1.0,
+    ):
+        if snapshot_path is not None and not -(2**63) <= id < 2**63:
+            raise ValueError(f"Snapshots need a 64-bit router id, not {id}")
         self.id = id
+        self.hello_interval = hello_interval
+        # A neighbor is declared down when no hello came for this long.
+        self.dead_interval = (
+            4 * hello_interval if dead_interval is None else dead_interval
+        )
+        self.lsa_interval = lsa_interval
+        self.transport = transport if transport is not None else TcpTransport()
+        self.wire_format = wire_format
+        self.flood_pacing = flood_pacing
+        self.max_queued_lsas = max_queued_lsas
+        self.max_queued_messages = max_queued_messages
+        self.send_queues = {}
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.fib_cache_size = fib_cache_size
+        # Own LSAs are originated with sequence numbers of at least the floor,
+        # and never above the mark reserved in the snapshot file.
+        self.sequence_floor = 0
+        self.sequence_reserved = -1
+        # Serializes snapshot writes, so an older mark never lands last
+        self.snapshot_lock = None
+        # Neighbors reconciled since the LSDB was restored from a snapshot;
+        # None when it was not.
+        self.reconciled = None
+        self.capabilities = [DB_SUMMARY]
+        if wire_format == BINARY:
+            self.capabilities.append(BINARY)
+        self.peer_capabilities = {}
+        # writer -> parts received so far of a message split with "more"
+        self.partial_messages = {}
+        # Neighbors to start a database exchange with once their hello says
+        # what they support
+        self.pending_exchanges = set()
         self.direct_connection = {}
         self.direct_links = {}
-        self.lsdb = LinkStateDatabase()
-        self.processed_lsas = set()
+        # neighbor id -> time.monotonic() of its last hello; the dead timers of
+        # all neighbors share one heap and loop timer.
+        self.last_heard = {}
+        self.dead_timers = DeadlineHeap(self._dead_interval_expired)
+        self.prefixes = []
+        self.metrics = MetricsRegistry({"node": id})
+        self.lsas_received = self.metrics.counter(
+            "lsas_received_total", "LSAs received in lsa messages"
+        )
+        self.lsas_duplicate = self.metrics.counter(
+            "lsas_duplicate_total", "Received LSAs dropped as already processed"
+        )
+        self.lsas_sent_back = self.metrics.counter(
+            "lsas_stale_sent_back_total",
+            "Newer LSAs sent back to a neighbor that flooded a stale one",
+        )
+        self.resyncs = self.metrics.counter(
+            "resyncs_total", "Database exchanges (resync or db_summary) handled"
+        )
+        self.bytes_received = self.metrics.counter(
+            "bytes_received_total", "Bytes of messages received from neighbors"
+        )
+        self.neighbors_dead = self.metrics.counter(
+            "neighbors_dead_total",
+            "Adjacencies torn down because no hello came within the dead interval",
+        )
+        self.malformed_frames = self.metrics.counter(
+            "malformed_frames_total",
+            "Connections closed because a neighbor sent an unreadable frame",
+        )
+        self.message_latency = self.metrics.histogram(
+            "message_handling_seconds", "Time spent handling one received message"
+        )
+        self.metrics.gauge(
+            "neighbors",
+            "Neighbors with an open connection",
+            callback=lambda: len(self.direct_connection),
+        )
+        self.metrics.gauge(
+            "send_queue_messages",
+            "Messages waiting in neighbor send queues",
+            callback=lambda: sum(len(queue) for queue in self.send_queues.values()),
+        )
+        # Own LSAs and SPF/FIB updates back off while changes keep coming.
+        self.lsa_throttle = Throttle(self._originate_lsa, lsa_min_hold, lsa_max_hold)
+        self.spf_throttle = Throttle(self._run_spf, spf_min_hold, spf_max_hold)
+        self.metrics.counter(
+            "lsa_originations_total",
+            "LSAs originated by this node",
+            callback=lambda: self.lsa_throttle.runs,
+        )
+        self.metrics.counter(
+            "lsa_originations_coalesced_total",
+            "Origination requests merged into one held down by the throttle",
+            callback=lambda: self.lsa_throttle.coalesced,
+        )
+        self.metrics.counter(
+            "spf_runs_total",
+            "Batches of LSA changes applied to SPF and the FIB",
+            callback=lambda: self.spf_throttle.runs,
+        )
+        self.metrics.counter(
+            "spf_runs_coalesced_total",
+            "LSA changes batched into an SPF run held down by the throttle",
+            callback=lambda: self.spf_throttle.coalesced,
+        )
+        # link_id -> latest LSA (None: removed) not yet applied to SPF
+        self.spf_pending = {}
+        self.spf = ShortestPathTree(id)
+        self.fib = ForwardingTable(self.spf, self.metrics, self.fib_cache_size)
+        self.lsdb = LinkStateDatabase(self.metrics)
+        self.lsdb.subscribe(self._lsdb_changed)
+        self.processed_lsas = DuplicateFilter()
         self.on = False
         self.server = None
+        self.metrics_server = None
+        # TraceRecorder while tracing (see start_tracing), else None
+        self.tracer = None
+
+    def _lsdb_changed(self, link_id, link_state_packet):
+        self.spf_pending[link_id] = link_state_packet
+        if self.spf_throttle.request():
+            self._run_spf()
+
+    def _run_spf(self):
+        tracer = self.tracer
+        if tracer is not None:
+            start = time.perf_counter()
+        pending, self.spf_pending = self.spf_pending, {}
+        for link_id, link_state_packet in pending.items():
+            changed = self.spf.update(link_id, link_state_packet)
+            self.fib.update(link_id, link_state_packet, changed)
+        if tracer is not None:
+            tracer.record("spf", "spf", start, None, {"lsas": len(pending)})
 
     async def turn_on(self):
         self.on = True
-        self.server = await asyncio.start_server(
-            self.accept_connections, "localhost", self.id
+        self.snapshot_lock = asyncio.Lock()
+        if self.snapshot_path is not None:
+            await self.load_snapshot()
+            asyncio.create_task(self.save_snapshot_periodically(self.snapshot_interval))
+        self.server = await self.transport.listen(self.id, self.accept_connections)
+        asyncio.create_task(self.send_lsa_periodically(self.lsa_interval))
+        asyncio.create_task(
+            self.send_hello_periodically(self.hello_interval)
+        )  # Schedule hello messages
+
+    async def load_snapshot(self):
+        """Fill the LSDB (and so SPF and the FIB) from the snapshot file."""
+        saved = load_lsdb(self.snapshot_path)
+        if saved is None or saved.router_id != self.id:
+            return
+        for lsa in saved.lsas:
+            packet = to_packet(lsa)
+            await self.lsdb.add(packet.link_state_id, packet)
+        self.spf_throttle.flush()
+        # Anything up to the reserved mark may already have been flooded.
+        self.sequence_reserved = saved.sequence_reserved
+        self.sequence_floor = max(self.sequence_floor, saved.sequence_reserved + 1)
+        self.reconciled = set()
+        logger.info(
+            "Restored %s LSAs on %s from %s", len(saved.lsas), self.id, self.snapshot_path
         )
-        asyncio.create_task(self.send_lsa_periodically(30))
-        asyncio.create_task(self.send_hello_periodically(15))  # Schedule hello messages
+
+    async def save_snapshot(self, sequence_reserved=None):
+        """Write the snapshot file in a worker thread; True if it was written.
+
+        The file records `sequence_reserved`, by default the current mark.
+        """
+        async with self.snapshot_lock:
+            if sequence_reserved is None:
+                sequence_reserved = self.sequence_reserved
+            # Published LSDB snapshots never change, so the thread can encode
+            # this one while the loop goes on.
+            lsas = list(self.lsdb.snapshot().values())
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, save_lsdb, self.snapshot_path, self.id, lsas, sequence_reserved
+                )
+            except (OSError, TypeError, ValueError, struct.error) as e:
+                logger.warning("Could not save LSDB snapshot of %s: %s", self.id, e)
+                return False
+            return True
+
+    async def save_snapshot_periodically(self, interval):
+        while self.on:
+            await asyncio.sleep(interval)
+            if self.on:
+                await self.save_snapshot()
+
+    def _next_sequence(self, old_lsa):
+        sequence_number = 0 if old_lsa is None else old_lsa.sequence_number + 1
+        return max(sequence_number, self.sequence_floor)
+
+    async def _reserve_sequence(self, sequence_number):
+        # Record a new mark before using numbers above the old one, so a
+        # restart never reuses a sequence number. The mark in memory only
+        # moves once the file holding it has been written.
+        reserved = sequence_number + SEQUENCE_BLOCK
+        if not await self.save_snapshot(reserved):
+            return False
+        self.sequence_reserved = max(self.sequence_reserved, reserved)
+        return True
 
     async def accept_connections(self, reader, writer):
         addr = writer.get_extra_info("peername")
-        print(f"Connection from {addr}")
+        logger.debug("Connection from %s on %s", addr, self.id)
+        # Neighbor that sent the last hello on this connection
+        neighbor = None
 
         while self.on:
             try:
-                data = await reader.readuntil(b"\r\n")
-            except (OSError, ConnectionResetError, EOFError) as e:
-                print(f"Connection from {addr} closed")
-                keys_to_delete = []
-                for key, conn in self.direct_connection.items():
-                    if conn == writer:
-                        print(f"Setting link from link-id: {self.id}:{key} to infinity")
-                        keys_to_delete.append(key)
-                        self.direct_links[key] = [key, -1]
-                        await self.lsdb.remove(key)
-                        new_lsa = await self.lsdb.get(self.id)
-                        if new_lsa is None:
-                            print(f"No LSA found for {self.id}, skipping for now")
-                            break
-                        new_lsa.links = [
-                            link for link in new_lsa.links if link.link_id != key
-                        ]
-                        new_lsa.sequence_number += 1
-                        await self.forward_lsa(
-                            {
-                                "type": "lsa",
-                                "id": self.id,
-                                "lsas": [new_lsa.to_dict()],
-                            },
-                            writer=writer,
-                        )
-                for key in keys_to_delete:
-                    self.direct_connection.pop(key)
+                frame = await read_frame(reader)
+            except (OSError, EOFError):
+                logger.info("Connection from %s to %s closed", addr, self.id)
+                await self._connection_lost(writer)
+                break
+            except (asyncio.LimitOverrunError, ValueError) as e:
+                await self._malformed_frame(addr, writer, neighbor, e)
+                break
+            if writer.is_closing():
+                # We closed this connection (link removed or neighbor declared
+                # dead); what is still buffered on it is stale.
+                continue
+            self.bytes_received.inc(len(frame))
+            start = time.perf_counter()
+            tracer = self.tracer
+            try:
+                message = decode_frame(frame)
+                if tracer is None:
+                    await self.handle_message(message, writer)
+                else:
+                    decoded = time.perf_counter()
+                    track = self._track(writer)
+                    tracer.record(track, "decode", start, decoded, {"bytes": len(frame)})
+                    await self.handle_message(message, writer)
+                    tracer.record(
+                        track,
+                        f"handle {message.get('type')}",
+                        decoded,
+                        None,
+                        {"from": message.get("id")},
+                    )
+            except (KeyError, TypeError, ValueError, struct.error) as e:
+                # Undecodable frames, missing fields and LSA records that run
+                # past their frame (decoded lazily while handling)
+                await self._malformed_frame(addr, writer, neighbor, e)
+                break
+            if message["type"] == "hello":
+                neighbor = message["id"]
+            self.message_latency.observe(time.perf_counter() - start)
+
+    async def _connection_lost(self, writer):
+        self.peer_capabilities.pop(writer, None)
+        self.partial_messages.pop(writer, None)
+        self._close_queue(writer)
+        for key, conn in list(self.direct_connection.items()):
+            if conn == writer:
+                await self._neighbor_down(key)
+
+    async def _malformed_frame(self, addr, writer, neighbor, error):
+        # The stream cannot be trusted past a bad frame, so take the adjacency
+        # down; it resynchronizes when the link is added again.
+        logger.warning(
+            "Malformed frame from %s on %s, closing the connection: %r",
+            addr,
+            self.id,
+            error,
+        )
+        self.malformed_frames.inc()
+        await self._drop_connection(writer, neighbor)
+
+    async def _drop_connection(self, writer, neighbor=None):
+        await self._connection_lost(writer)
+        writer.close()
+        # The neighbor may send here and read from a connection of ours;
+        # close that one too so both ends see the adjacency go down.
+        own = self.direct_connection.get(neighbor)
+        if own is not None:
+            await self._neighbor_down(neighbor)
+            own.close()
+
+    @staticmethod
+    def _track(writer):
+        # Trace track of the reader loop of the connection behind `writer`
+        return f"recv {writer.get_extra_info('peername')}"
+
+    async def _neighbor_down(self, neighbor):
+        """Mark the link to `neighbor` down and originate an LSA without it."""
+        writer = self.direct_connection.pop(neighbor, None)
+        if writer is None:
+            return
+        logger.info("Setting link from link-id: %s:%s to infinity", self.id, neighbor)
+        self.peer_capabilities.pop(writer, None)
+        self.partial_messages.pop(writer, None)
+        self._close_queue(writer)
+        self._forget_neighbor(neighbor)
+        self.direct_links[neighbor] = [neighbor, -1]
+        await self.lsdb.remove(neighbor)
+        await self.send_neighbor_lsa()
+
+    def _heard_from(self, neighbor):
+        now = time.monotonic()
+        self.last_heard[neighbor] = now
+        # Hellos only move last_heard; the heap entry is pushed back lazily
+        # when it expires, so a hello costs no heap operation.
+        if neighbor not in self.dead_timers:
+            self.dead_timers.schedule(neighbor, now + self.dead_interval)
+
+    def _forget_neighbor(self, neighbor):
+        self.pending_exchanges.discard(neighbor)
+        self.last_heard.pop(neighbor, None)
+        self.dead_timers.cancel(neighbor)
+
+    def _dead_interval_expired(self, neighbor):
+        heard = self.last_heard.get(neighbor)
+        if heard is None or not self.on:
+            return
+        deadline = heard + self.dead_interval
+        if deadline > time.monotonic():
+            self.dead_timers.schedule(neighbor, deadline)
+        else:
+            asyncio.create_task(self._neighbor_dead(neighbor))
+
+    async def _neighbor_dead(self, neighbor):
+        writer = self.direct_connection.get(neighbor)
+        if writer is None:
+            return
+        logger.warning(
+            "No hello from %s on %s for %ss, declaring it down",
+            neighbor,
+            self.id,
+            self.dead_interval,
+        )
+        self.neighbors_dead.inc()
+        await self._neighbor_down(neighbor)
+        # Closing our end also tells the peer, should it still be listening.
+        writer.close()
+
+    def _encoding_for(self, writer):
+        if self.wire_format == BINARY and BINARY in self.peer_capabilities.get(
+            writer, ()
+        ):
+            return BINARY
+        return JSON
+
+    def _queue_for(self, writer):
+        queue = self.send_queues.get(writer)
+        if queue is None:
+            if writer.is_closing():
+                return None
+            queue = self.send_queues[writer] = NeighborQueue(
+                writer,
+                self.id,
+                encoding=lambda: self._encoding_for(writer),
+                metrics=self.metrics,
+                pacing=self.flood_pacing,
+                max_lsas=self.max_queued_lsas,
+                max_control=self.max_queued_messages,
+                on_overflow=self._queue_overflowed,
+                on_failure=self._queue_failed,
+                tracer=self.tracer,
+            )
+            queue.start()
+        return queue
+
+    def _close_queue(self, writer):
+        queue = self.send_queues.pop(writer, None)
+        if queue is not None:
+            queue.close()
+
+    def _queue_overflowed(self, queue):
+        # The dropped messages are lost for good, so bring the neighbor back in
+        # sync with a database exchange once the queue drains.
+        for neighbor, conn in self.direct_connection.items():
+            if conn is queue.writer:
+                logger.warning(
+                    "Send queue from %s to %s overflowed, resynchronizing",
+                    self.id,
+                    neighbor,
+                )
+                asyncio.create_task(self._start_exchange(conn, neighbor))
                 break
-            message = json.loads(data.decode())
-            await self.handle_message(message, writer)
+
+    def _queue_failed(self, queue):
+        # Nothing drains a queue whose writer task died, so take the
+        # adjacency down rather than keep filling it.
+        if self.send_queues.get(queue.writer) is queue:
+            asyncio.create_task(self._drop_connection(queue.writer))
+
+    async def _send(self, writer, message):
+        queue = self._queue_for(writer)
+        if queue is not None:
+            queue.put_control(message)
 
     async def handle_message(self, message, writer):
+        if message["type"] in CONTINUED:
+            # Large resync and db_summary messages arrive in parts, written
+            # back to back; handle them once the last part is in.
+            more = message.get("more")
+            partial = self.partial_messages.pop(writer, None)
+            if partial is not None:
+                field = SPLIT_FIELDS[message["type"]]
+                partial[field].extend(message[field])
+                if len(partial[field]) > MAX_JOINED_ENTRIES:
+                    # Raised to the reader loop, which drops the connection
+                    raise ValueError(
+                        f"{message['type']} parts exceed {MAX_JOINED_ENTRIES} entries"
+                    )
+                message = partial
+            if more:
+                self.partial_messages[writer] = message
+                return
+
         if message["type"] == "hello":
-            # print(f"Message: {message}")
+            self.peer_capabilities[writer] = message.get("capabilities", [])
+            self._heard_from(message["id"])
+            adjacency_new = message["id"] not in self.direct_connection
             # await self.send_hello()  # Acknowledge hello by sending another hello
             if (
                 message["id"] in self.direct_links
                 and self.direct_links[message["id"]][1] == -1
             ):
-                print(f"Link to {message['id']} has come up again")
+                logger.info("Link from %s to %s has come up again", self.id, message["id"])
                 self.direct_connection[message["id"]] = writer
                 self.direct_links[message["id"]][1] = message["cost"]
                 if self.id < message["id"]:
-                    own_lsa = await self.lsdb.get(self.id)
-                    if own_lsa is None:
-                        print(f"No LSA found for {self.id}, skipping for now")
-                    else:
-                        own_lsa.links.append((message["id"], message["cost"]))
-                        own_lsa.sequence_number += 1
-                        await self.lsdb.add(self.id, own_lsa)
-                    lsas = await self.lsdb.get_all()
-                    writer.write(
-                        (
-                            json.dumps(
-                                {
-                                    "type": "resync",
-                                    "id": self.id,
-                                    "lsas": [
-                                        lsa.to_dict()
-                                        for lsa in lsas.values()
-                                        if lsa.link_state_id != message["id"]
-                                    ],
-                                }
-                            )
-                            + "\r\n"
-                        ).encode()
-                    )
-                    await writer.drain()
+                    await self.send_neighbor_lsa()
+                    await self._start_exchange(writer, message["id"])
 
             if message["id"] not in self.direct_connection:
                 self.direct_connection[message["id"]] = writer
@@ -105,40 +486,67 @@ class LinkStateNode:
             elif message["id"] in self.direct_connection:
                 self.direct_links[message["id"]][1] = message["cost"]
 
+            if adjacency_new:
+                # Answer a new or returning neighbor right away so it learns
+                # our capabilities without waiting for the next periodic hello.
+                queue = self._queue_for(writer)
+                if queue is not None:
+                    queue.put_hello(self._hello(message["cost"]))
+
+            if message["id"] in self.pending_exchanges:
+                self.pending_exchanges.discard(message["id"])
+                await self._start_exchange(writer, message["id"])
+
+            if self.reconciled is not None and message["id"] not in self.reconciled:
+                # Our LSDB came from a snapshot; only exchange what changed.
+                self.reconciled.add(message["id"])
+                await self._start_exchange(writer, message["id"])
+
         elif message["type"] == "lsa":
             await self._handle_lsa(message, writer)
 
         elif message["type"] == "resync":
             await self._handle_resync(message, writer)
 
+        elif message["type"] == "db_summary":
+            await self._handle_db_summary(message, writer)
+
+        elif message["type"] == "ls_request":
+            await self._handle_ls_request(message, writer)
+
+        elif message["type"] == "ls_update":
+            await self._handle_ls_update(message, writer)
+
         else:
-            print("Invalid message type")
+            logger.warning("Invalid message type %r on %s", message.get("type"), self.id)
 
     async def _handle_lsa(self, message, writer):
+        self.lsas_received.inc(len(message["lsas"]))
         for lsa in message["lsas"]:
             state = (lsa["link_state_id"], lsa["sequence_number"])
             if state not in self.processed_lsas:
                 self.processed_lsas.add(state)
                 item = await self.lsdb.get(lsa["link_state_id"])
                 if item is None:
-                    await self.lsdb.add(
-                        lsa["link_state_id"],
-                        LinkStatePacket.from_dict(lsa),
+                    await self._install(lsa, writer, message["id"])
+                    await self.forward_lsa(
+                        {"type": "lsa", "id": message["id"], "lsas": [lsa]},
+                        writer=writer,
                     )
-                    await self.forward_lsa(message, writer=writer)
 
                 else:
                     if lsa["sequence_number"] >= item.sequence_number:
-                        await self.lsdb.add(
-                            lsa["link_state_id"],
-                            LinkStatePacket.from_dict(lsa),
+                        await self._install(lsa, writer, message["id"])
+                        await self.forward_lsa(
+                            {"type": "lsa", "id": message["id"], "lsas": [lsa]},
+                            writer=writer,
                         )
-                        await self.forward_lsa(message, writer=writer)
                     else:
-                        print(
+                        logger.debug(
                             "LSA sequence number is not greater than the one in the database. "
                             "Forwarding most recent LSA"
                         )
+                        self.lsas_sent_back.inc()
                         new_lsa = await self.lsdb.get(lsa["link_state_id"])
                         await self.forward_lsa(
                             {
@@ -150,105 +558,246 @@ class LinkStateNode:
                             writer=writer,
                         )
             else:
-                print(
-                    f"LSA {lsa['link_state_id']} with sequence number {lsa['sequence_number']} already processed"
+                self.lsas_duplicate.inc()
+                logger.debug(
+                    "LSA %s with sequence number %s already processed",
+                    lsa["link_state_id"],
+                    lsa["sequence_number"],
                 )
 
     async def _handle_resync(self, message, writer):
-        print(f"handling resync on {self.id} with message: {message}")
-        print(self.direct_links)
+        self.resyncs.inc()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("handling resync on %s with message: %s", self.id, message)
+            logger.debug("direct links of %s: %s", self.id, self.direct_links)
         if self.id > message["id"]:
             lsas = await self.lsdb.get_all()
-            writer.write(
-                (
-                    json.dumps(
-                        {
-                            "type": "resync",
-                            "id": self.id,
-                            "lsas": [
-                                lsa.to_dict()
-                                for lsa in lsas.values()
-                                if lsa.link_state_id != message["id"]
-                            ],
-                        }
-                    )
-                    + "\r\n"
-                ).encode()
+            await self._send(
+                writer,
+                {
+                    "type": "resync",
+                    "id": self.id,
+                    "lsas": [
+                        lsa.to_dict()
+                        for lsa in lsas.values()
+                        if lsa.link_state_id != message["id"]
+                    ],
+                },
             )
-            await writer.drain()
 
-        for lsa in message["lsas"]:
+        await self._install_newer(message["lsas"], writer, message["id"])
+        await self.send_neighbor_lsa()
+
+    async def _install(self, lsa, writer, sender):
+        """Store a received LSA, recording an "install" span when tracing."""
+        tracer = self.tracer
+        if tracer is not None:
+            start = time.perf_counter()
+        packet = to_packet(lsa)
+        await self.lsdb.add(packet.link_state_id, packet)
+        if tracer is not None:
+            tracer.record(
+                self._track(writer),
+                "install",
+                start,
+                None,
+                {
+                    "lsid": packet.link_state_id,
+                    "seq": packet.sequence_number,
+                    "from": sender,
+                },
+            )
+
+    async def _install_newer(self, lsas, writer, sender):
+        installed = []
+        for lsa in lsas:
             cur_lsa = await self.lsdb.get(lsa["link_state_id"])
             if (
                 cur_lsa is None
                 or lsa.get("sequence_number", 0) > cur_lsa.sequence_number
             ):
-                await self.lsdb.add(
-                    lsa["link_state_id"], LinkStatePacket.from_dict(lsa)
+                await self._install(lsa, writer, sender)
+                # Like flooded LSAs, so the copy that comes back is a duplicate.
+                self.processed_lsas.add((lsa["link_state_id"], lsa["sequence_number"]))
+                installed.append(lsa)
+        return installed
+
+    async def _start_exchange(self, writer, neighbor_id):
+        # Peers that understand database summaries only get the LSA headers and
+        # request what they miss; older peers get the whole LSDB as a resync.
+        if DB_SUMMARY in self.peer_capabilities.get(writer, ()):
+            await self._send_db_summary(writer, neighbor_id)
+            return
+        lsas = await self.lsdb.get_all()
+        await self._send(
+            writer,
+            {
+                "type": "resync",
+                "id": self.id,
+                "lsas": [
+                    lsa.to_dict()
+                    for lsa in lsas.values()
+                    if lsa.link_state_id != neighbor_id
+                ],
+            },
+        )
+
+    async def _send_db_summary(self, writer, neighbor_id, reply=False):
+        lsas = await self.lsdb.get_all()
+        message = {
+            "type": "db_summary",
+            "id": self.id,
+            "headers": [
+                {
+                    "router_id": lsa.router_id,
+                    "link_state_id": lsa.link_state_id,
+                    "sequence_number": lsa.sequence_number,
+                }
+                for lsa in lsas.values()
+                if lsa.link_state_id != neighbor_id
+            ],
+        }
+        if reply:
+            message["reply"] = True
+        await self._send(writer, message)
+
+    async def _handle_db_summary(self, message, writer):
+        self.resyncs.inc()
+        logger.debug("handling db summary on %s from %s", self.id, message["id"])
+        lsas = await self.lsdb.get_all()
+        if self.id > message["id"]:
+            if not message.get("reply"):
+                await self._send_db_summary(writer, message["id"], reply=True)
+        elif not message.get("reply"):
+            # The sender does not get our summary back, so send it what it
+            # lacks directly. A reply to our own summary needs nothing more:
+            # the sender requests what it lacks, as it has our headers.
+            headers = {
+                header["link_state_id"]: header["sequence_number"]
+                for header in message["headers"]
+            }
+            newer = [
+                lsa.to_dict()
+                for link_state_id, lsa in lsas.items()
+                if link_state_id != message["id"]
+                and lsa.sequence_number > headers.get(link_state_id, -1)
+            ]
+            if newer:
+                await self._send(
+                    writer, {"type": "ls_update", "id": self.id, "lsas": newer}
                 )
 
-        await self.send_neighbor_lsa()
+        wanted = []
+        for header in message["headers"]:
+            cur_lsa = lsas.get(header["link_state_id"])
+            if cur_lsa is None or header["sequence_number"] > cur_lsa.sequence_number:
+                wanted.append(header["link_state_id"])
+        if wanted:
+            await self._send(
+                writer, {"type": "ls_request", "id": self.id, "link_state_ids": wanted}
+            )
+
+        # A summary after a send queue overflow does not change the adjacency;
+        # re-originating then would only start another flood.
+        own_lsa = lsas.get(self.id)
+        if own_lsa is None or {
+            (link.link_id, link.cost) for link in own_lsa.links
+        } != {(key, self.direct_links[key][1]) for key in self.direct_connection}:
+            await self.send_neighbor_lsa()
+
+    async def _handle_ls_request(self, message, writer):
+        lsas = await self.lsdb.get_all()
+        await self._send(
+            writer,
+            {
+                "type": "ls_update",
+                "id": self.id,
+                "lsas": [
+                    lsas[link_state_id].to_dict()
+                    for link_state_id in message["link_state_ids"]
+                    if link_state_id in lsas
+                ],
+            },
+        )
+
+    async def _handle_ls_update(self, message, writer):
+        # Flood what was missing here on to the other neighbors, which may have
+        # missed it too if it was dropped from an overflowing send queue.
+        installed = await self._install_newer(message["lsas"], writer, message["id"])
+        if installed:
+            await self.forward_lsa(
+                {"type": "ls_update", "id": message["id"], "lsas": installed},
+                writer=writer,
+            )
 
     async def turn_off(self):
         self.on = False
+        if self.snapshot_path is not None:
+            await self.save_snapshot()
+        self.reconciled = None
         if self.server:
             self.server.close()
             await self.server.wait_closed()
         for key in self.direct_connection:
             self.direct_connection[key].close()
         self.direct_connection.clear()
-        self.lsdb = LinkStateDatabase()
+        self.direct_links.clear()
+        self.last_heard.clear()
+        self.pending_exchanges.clear()
+        self.partial_messages.clear()
+        self.dead_timers.close()
+        for queue in self.send_queues.values():
+            queue.close()
+        self.send_queues.clear()
+        self.lsa_throttle.cancel()
+        self.spf_throttle.cancel()
+        self.spf_pending.clear()
+        self.lsdb.close()
+        self.spf = ShortestPathTree(self.id)
+        self.fib = ForwardingTable(self.spf, self.metrics, self.fib_cache_size)
+        self.lsdb = LinkStateDatabase(self.metrics)
+        self.lsdb.subscribe(self._lsdb_changed)
 
     async def add_link(self, node: int, cost: int):
+        if cost < 1:
+            raise ValueError(f"Link cost must be at least 1, not {cost}")
         if not self.on:
-            print("Node is off")
+            logger.debug("Node %s is off", self.id)
             return
 
         if node not in self.direct_connection and node not in self.direct_links:
-            reader, writer = await asyncio.open_connection("localhost", node)
+            reader, writer = await self.transport.connect(node)
             self.direct_connection[node] = writer
             self.direct_links[node] = [node, cost]
+            self._heard_from(node)
             await self.send_hello()  # Send a hello when adding a link
             asyncio.create_task(self.accept_connections(reader, writer))
-        elif node in self.direct_links and self.direct_links[node][0] == -1:
-            reader, writer = await asyncio.open_connection("localhost", node)
+        elif node in self.direct_links and self.direct_links[node][1] == -1:
+            reader, writer = await self.transport.connect(node)
             asyncio.create_task(self.accept_connections(reader, writer))
             self.direct_connection[node] = writer
-            print(f"Link to {node} has come up again")
+            logger.info("Link from %s to %s has come up again", self.id, node)
             self.direct_links[node] = [node, cost]
-            await self.send_hello()
+            self._heard_from(node)
             if self.id < node:
-                lsas = await self.lsdb.get_all()
-                print("current lsdb:", lsas)
-                writer.write(
-                    (
-                        json.dumps(
-                            {
-                                "type": "resync",
-                                "id": self.id,
-                                "lsas": [
-                                    lsa.to_dict()
-                                    for lsa in lsas.values()
-                                    if lsa.link_state_id != node
-                                ],
-                            }
-                        )
-                        + "\r\n"
-                    ).encode()
-                )
-                await writer.drain()
+                # Wait for the neighbor's hello: until it arrives we do not
+                # know whether it understands db_summary or binary frames.
+                self.pending_exchanges.add(node)
+            await self.send_hello()
 
         else:
-            print(f"Link to {node} already exists")
+            logger.info("Link from %s to %s already exists", self.id, node)
 
     async def remove_link(self, node: int):
         if not self.on:
-            print("Node is off")
+            logger.debug("Node %s is off", self.id)
             return
 
         if node in self.direct_connection:
-            print(f"Removing link to {node} from {self.id}")
+            logger.info("Removing link to %s from %s", node, self.id)
             writer = self.direct_connection.pop(node)
+            self._close_queue(writer)
+            self._forget_neighbor(node)
             writer.close()
             await self.lsdb.remove(node)
             self.direct_links.pop(node, None)
@@ -256,81 +805,180 @@ class LinkStateNode:
 
     async def send_hello(self):
         if not self.on:
-            print("Node is off")
+            logger.debug("Node %s is off", self.id)
             return
 
-        for key, val in self.direct_connection.items():
+        for key, val in list(self.direct_connection.items()):
             item = self.direct_links.get(key)
             if item:
-                message = {
-                    "type": "hello",
-                    "id": self.id,
-                    "cost": item[1],
-                }
-                # print(f'sending hello from {self.id}')
-                val.write((json.dumps(message) + "\r\n").encode())
-                await val.drain()  # Ensure the message is sent
+                queue = self._queue_for(val)
+                if queue is not None:
+                    queue.put_hello(self._hello(item[1]))
+
+    def _hello(self, cost):
+        return {
+            "type": "hello",
+            "id": self.id,
+            "cost": cost,
+            "capabilities": self.capabilities,
+        }
 
     async def send_neighbor_lsa(
         self,
     ):
+        """Originate this node's LSA, or have it originated once the hold-down
+        of the origination throttle has passed."""
+        if not self.on:
+            logger.debug("Node %s is off", self.id)
+            return
+        if self.lsa_throttle.request():
+            await self._originate_lsa()
+
+    async def _originate_lsa(self):
         if not self.on:
-            print("Node is off")
             return
+        tracer = self.tracer
+        if tracer is not None:
+            start = time.perf_counter()
+        while True:
+            old_lsa = await self.lsdb.get(self.id)
+            sequence_number = self._next_sequence(old_lsa)
+            if self.snapshot_path is None or sequence_number <= self.sequence_reserved:
+                break
+            if not await self._reserve_sequence(sequence_number):
+                # Retried by the next origination, at the latest the periodic
+                # refresh.
+                logger.warning(
+                    "Not originating the LSA of %s: could not reserve sequence number %s",
+                    self.id,
+                    sequence_number,
+                )
+                return
+            if not self.on:
+                return
+            # Other originations may have run while the file was written, so
+            # look at the stored LSA again.
         links = []
         for key, val in self.direct_connection.items():
             links.append(Link(key, self.direct_links[key][1]))
-
-            # print(f'sending lsa from {self.id} to {key}')
-        old_lsa = await self.lsdb.get(self.id)
         if old_lsa is None:
-            old_lsa = LinkStatePacket(self.id, 0, self.id, links, 60)
+            new_lsa = LinkStatePacket(
+                self.id, sequence_number, self.id, links, 60, list(self.prefixes)
+            )
         else:
-            old_lsa.links = links
-            old_lsa.sequence_number += 1
-            old_lsa.ttl = 60
-        await self.lsdb.add(old_lsa.link_state_id, old_lsa)
-
-        for neighb_conn in self.direct_connection.values():
-            # print(f'sending lsas: {lsas_to_send} from {self.id}')
-            neighb_conn.write(
-                (
-                    json.dumps(
-                        {"type": "lsa", "id": self.id, "lsas": [old_lsa.to_dict()]}
-                    )
-                    + "\r\n"
-                ).encode()
+            new_lsa = old_lsa.replace(
+                links=links,
+                prefixes=list(self.prefixes),
+                sequence_number=sequence_number,
+                ttl=60,
+            )
+        await self.lsdb.add(new_lsa.link_state_id, new_lsa)
+        self._queue_flood(new_lsa.to_dict(), None)
+        if tracer is not None:
+            tracer.record(
+                "originate",
+                "originate",
+                start,
+                None,
+                {"lsid": self.id, "seq": new_lsa.sequence_number},
             )
-            await neighb_conn.drain()
 
     async def forward_lsa(self, message, writer, send_back=False):
         if not self.on:
-            print("Node is off")
+            logger.debug("Node %s is off", self.id)
             return
         if send_back:
-            writer.write((json.dumps(message) + "\r\n").encode())
-            await writer.drain()
+            queue = self._queue_for(writer)
+            if queue is not None:
+                for lsa in message["lsas"]:
+                    queue.put_lsa(EncodedLsa(lsa))
         else:
-            # Forward received LSAs to all directly connected neighbors except the sender
-            for neighbor_id, conn in self.direct_connection.items():
-                if conn != writer:
-                    # print(f'Forwarding LSA:{message} from {message["id"]} to {neighbor_id}')
-                    conn.write((json.dumps(message) + "\r\n").encode())
-                    await writer.drain()
+            for lsa in message["lsas"]:
+                self._queue_flood(lsa, writer)
+
+    def _queue_flood(self, lsa, writer):
+        # Queue the LSA to every neighbor except the one it came from. All
+        # queues share one EncodedLsa, so it is serialized only once.
+        tracer = self.tracer
+        if tracer is not None:
+            start = time.perf_counter()
+        item = EncodedLsa(lsa)
+        for conn in list(self.direct_connection.values()):
+            if conn is not writer:
+                queue = self._queue_for(conn)
+                if queue is not None:
+                    queue.put_lsa(item)
+        if tracer is not None:
+            tracer.record(
+                "originate" if writer is None else self._track(writer),
+                "flood",
+                start,
+                None,
+                {"lsid": item.link_state_id, "seq": item.sequence_number},
+            )
 
     async def send_lsa_periodically(self, interval):
         while self.on:
             await self.send_neighbor_lsa()
-            await asyncio.sleep(interval + random.randint(-5, 5))
+            await asyncio.sleep(interval + random.uniform(-interval / 6, interval / 6))
 
     async def send_hello_periodically(self, interval):
         while self.on:
             await self.send_hello()
             await asyncio.sleep(interval)
 
+    async def add_prefix(self, prefix: str):
+        """Advertise an attached CIDR such as "10.0.1.0/24" in this node's LSA."""
+        prefix = IpPrefixTrie.normalize_prefix(prefix)
+        if prefix not in self.prefixes:
+            self.prefixes.append(prefix)
+            await self.send_neighbor_lsa()
+
+    async def remove_prefix(self, prefix: str):
+        prefix = IpPrefixTrie.normalize_prefix(prefix)
+        if prefix in self.prefixes:
+            self.prefixes.remove(prefix)
+            await self.send_neighbor_lsa()
+
+    def lookup(self, ip: str):
+        """Return the (prefix, next_hops) the FIB forwards `ip` with, or None."""
+        return self.fib.lookup(ip)
+
+    def next_hop(self, ip: str, flow):
+        """Return the one equal-cost next hop packets of `flow` to `ip` take."""
+        return self.fib.next_hop(ip, flow)
+
+    def start_tracing(self, capacity: int = 65536) -> TraceRecorder:
+        """Record pipeline spans into a new ring buffer of `capacity` spans."""
+        self.tracer = TraceRecorder(self.id, capacity)
+        for queue in self.send_queues.values():
+            queue.tracer = self.tracer
+        return self.tracer
+
+    def stop_tracing(self) -> TraceRecorder:
+        tracer, self.tracer = self.tracer, None
+        for queue in self.send_queues.values():
+            queue.tracer = None
+        return tracer
+
+    async def start_metrics_server(self, port: int, host: str = "127.0.0.1"):
+        """Export this node's metrics in Prometheus text format over HTTP."""
+        self.metrics_server = await serve_metrics(self.metrics, host, port)
+
     def show_peers(self):
         print(self.direct_connection.keys())
 
+    def routing_table(self):
+        return self.spf.routes()
+
+    def show_routes(self):
+        for destination, (cost, next_hops) in sorted(self.routing_table().items()):
+            print(f"{destination}: cost={cost}, next_hops={sorted(next_hops)}")
+
+    def show_fib(self):
+        for prefix, (cost, next_hops) in sorted(self.fib.routes().items()):
+            print(f"{prefix}: cost={cost}, next_hops={sorted(next_hops)}")
+
 
 async def main():
     node1 = LinkStateNode(8080)
@@ -366,4 +1014,5 @@ async def main():
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
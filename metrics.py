@@ -0,0 +1,183 @@
+"""Low-overhead counters, gauges and histograms with Prometheus text export.
+
+Hot paths hold on to the metric objects themselves, so recording a value is an
+attribute update (plus a bisect for histograms). Counters and gauges can be
+backed by a callback that is only evaluated when the registry is rendered.
+"""
+import asyncio
+import math
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, callback=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.callback = callback
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, labels):
+        yield self.name, labels, self.callback() if self.callback else self.value
+
+
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name, help, callback=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.callback = callback
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, labels):
+        yield self.name, labels, self.callback() if self.callback else self.value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            yield f"{self.name}_bucket", {**labels, "le": format_value(bound)}, cumulative
+        yield f"{self.name}_sum", labels, self.sum
+        yield f"{self.name}_count", labels, self.count
+
+
+class MetricsRegistry:
+    """Named metrics sharing a set of constant labels (such as the node id).
+
+    Asking for a metric that already exists returns the existing object, so
+    components that are rebuilt (an LSDB after `turn_off`) keep counting into
+    the same series.
+    """
+
+    def __init__(self, labels=None, prefix="lsr_"):
+        self.labels = dict(labels or {})
+        self.prefix = prefix
+        self.metrics = {}
+
+    def _get(self, cls, name, help, **kwargs):
+        name = self.prefix + name
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"Metric {name} is already registered as a {metric.type}")
+        return metric
+
+    def counter(self, name, help, callback=None):
+        counter = self._get(Counter, name, help)
+        if callback is not None:
+            counter.callback = callback
+        return counter
+
+    def gauge(self, name, help, callback=None):
+        gauge = self._get(Gauge, name, help)
+        if callback is not None:
+            gauge.callback = callback
+        return gauge
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def render(self):
+        return render_prometheus([self])
+
+
+def render_prometheus(registries):
+    """Render several registries (one per node) as one Prometheus text page."""
+    families = {}
+    for registry in registries:
+        for name, metric in registry.metrics.items():
+            families.setdefault(name, []).append((registry, metric))
+    lines = []
+    for name, members in sorted(families.items()):
+        first = members[0][1]
+        lines.append(f"# HELP {name} {first.help}")
+        lines.append(f"# TYPE {name} {first.type}")
+        for registry, metric in members:
+            for sample_name, labels, value in metric.samples(registry.labels):
+                lines.append(f"{sample_name}{format_labels(labels)} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+async def serve(registries, host="127.0.0.1", port=9464):
+    """Serve the registries on http://host:port/metrics until closed.
+
+    `registries` is a registry or a list of them; a list can keep growing
+    while the server runs.
+    """
+    if isinstance(registries, MetricsRegistry):
+        registries = [registries]
+
+    async def handle(reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            writer.close()
+            return
+        path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+        if path.split(b"?")[0] in (b"/", b"/metrics"):
+            status, body = "200 OK", render_prometheus(registries).encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+        writer.write(
+            (
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode()
+            + body
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,212 @@
+"""Per-neighbor outbound queues, each drained by its own writer task.
+
+A slow or dead peer only backs up its own queue: hellos, database exchange
+messages and flooded LSAs to every other neighbor keep flowing, and the
+reader loop that handles the peer's messages never waits on a drain.
+"""
+import asyncio
+import collections
+import logging
+import time
+
+from metrics import MetricsRegistry
+from wire_protocol import JSON, encode_lsa_frames, encode_messages
+
+logger = logging.getLogger(__name__)
+
+
+class NeighborQueue:
+    """Bounded outbound queue for one neighbor connection.
+
+    Messages are written in priority order: the latest hello, then control
+    messages (resync, db_summary, ls_request, ls_update) in FIFO order, then
+    LSAs. Queued LSAs are keyed by link_state_id, so a newer instance replaces
+    an older one that has not been written yet. LSAs are held for `pacing`
+    seconds before being written so bursts go out together, in as few frames as
+    `wire_protocol.FRAME_BUDGET` allows.
+
+    When more than `max_lsas` LSAs or `max_control` control messages are
+    waiting, the queue drops everything but the hello. Once the neighbor
+    accepts writes again it calls `on_overflow(queue)` (once, however many
+    overflows happened meanwhile); the owner is expected to resynchronize
+    the neighbor. If the writer task fails on anything but a closed
+    connection, it calls `on_failure(queue)` and stops; the owner is expected
+    to drop the connection.
+
+    With a `tracer` (a `tracing.TraceRecorder`), LSA writes and drains are
+    recorded as spans on the queue's own track.
+    """
+
+    def __init__(
+        self,
+        writer,
+        sender,
+        encoding=lambda: JSON,
+        metrics: MetricsRegistry = None,
+        pacing: float = 0.02,
+        max_lsas: int = 1024,
+        max_control: int = 64,
+        on_overflow=None,
+        on_failure=None,
+        tracer=None,
+    ):
+        self.writer = writer
+        self.sender = sender
+        self.encoding = encoding
+        self.pacing = pacing
+        self.max_lsas = max_lsas
+        self.max_control = max_control
+        self.on_overflow = on_overflow
+        self.on_failure = on_failure
+        self.tracer = tracer
+        self.track = f"send {writer.get_extra_info('peername')}"
+        self.hello = None
+        self.control = collections.deque()
+        self.lsas = {}
+        self.overflowed = False
+        self.wakeup = asyncio.Event()
+        self.task = None
+        metrics = metrics if metrics is not None else MetricsRegistry()
+        self.bytes_sent = metrics.counter(
+            "bytes_sent_total", "Bytes of messages written to neighbors"
+        )
+        self.lsas_forwarded = metrics.counter(
+            "lsas_forwarded_total", "LSAs written to neighbors while flooding"
+        )
+        self.lsas_superseded = metrics.counter(
+            "lsas_superseded_total",
+            "Queued LSAs replaced by a newer instance before being written",
+        )
+        self.overflows = metrics.counter(
+            "send_queue_overflows_total", "Neighbor send queues that overflowed"
+        )
+        self.dropped = metrics.counter(
+            "send_queue_dropped_total", "Messages dropped when a send queue overflowed"
+        )
+
+    def __len__(self):
+        return (self.hello is not None) + len(self.control) + len(self.lsas)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.hello = None
+        self.control.clear()
+        self.lsas.clear()
+
+    def put_hello(self, message):
+        self.hello = message
+        self.wakeup.set()
+
+    def put_control(self, message):
+        if len(self.control) >= self.max_control:
+            self._overflow()
+            return False
+        self.control.append(message)
+        self.wakeup.set()
+        return True
+
+    def put_lsa(self, item):
+        """Queue an `EncodedLsa`, superseding an older queued instance."""
+        queued = self.lsas.get(item.link_state_id)
+        if queued is not None:
+            if item.sequence_number < queued.sequence_number:
+                return True
+            self.lsas_superseded.inc()
+        elif len(self.lsas) >= self.max_lsas:
+            self._overflow()
+            return False
+        self.lsas[item.link_state_id] = item
+        self.wakeup.set()
+        return True
+
+    def _overflow(self):
+        self.overflows.inc()
+        self.dropped.inc(len(self.control) + len(self.lsas))
+        self.control.clear()
+        self.lsas.clear()
+        self.overflowed = True
+        self.wakeup.set()
+
+    def _write(self, data):
+        self.writer.write(data)
+        self.bytes_sent.inc(len(data))
+
+    def _write_frames(self, frames):
+        for frame in frames:
+            self._write(frame)
+
+    def _write_control(self):
+        encoding = self.encoding()
+        if self.hello is not None:
+            message, self.hello = self.hello, None
+            self._write_frames(encode_messages(message, encoding))
+        while self.control:
+            self._write_frames(encode_messages(self.control.popleft(), encoding))
+
+    def _write_lsas(self):
+        tracer = self.tracer
+        if tracer is not None:
+            start = time.perf_counter()
+        items = list(self.lsas.values())
+        self.lsas.clear()
+        frames = encode_lsa_frames(self.sender, items, self.encoding())
+        self._write_frames(frames)
+        self.lsas_forwarded.inc(len(items))
+        if tracer is not None:
+            tracer.record(
+                self.track,
+                "write lsas",
+                start,
+                None,
+                {
+                    "lsas": len(items),
+                    "frames": len(frames),
+                    "bytes": sum(len(frame) for frame in frames),
+                },
+            )
+
+    async def _drain(self):
+        tracer = self.tracer
+        if tracer is None:
+            await self.writer.drain()
+            return
+        start = time.perf_counter()
+        await self.writer.drain()
+        tracer.record(self.track, "drain", start)
+
+    async def run(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                self._write_control()
+                await self._drain()
+                if self.overflowed:
+                    self.overflowed = False
+                    if self.on_overflow is not None:
+                        self.on_overflow(self)
+                if self.lsas:
+                    if self.pacing:
+                        await asyncio.sleep(self.pacing)
+                    # Hellos and control messages queued while pacing still
+                    # go ahead of the LSAs.
+                    self._write_control()
+                    if self.lsas:
+                        self._write_lsas()
+                    await self._drain()
+        except (OSError, ConnectionError) as e:
+            logger.debug(
+                "Writer to %s stopped: %s", self.writer.get_extra_info("peername"), e
+            )
+        except Exception:
+            logger.exception(
+                "Writer to %s failed", self.writer.get_extra_info("peername")
+            )
+            if self.on_failure is not None:
+                self.on_failure(self)
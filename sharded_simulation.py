@@ -0,0 +1,351 @@
+"""Run a LinkStateNode simulation sharded over several worker processes.
+
+The topology is split into `--shards` connected blocks of nodes. Every worker
+process runs its block on its own event loop and `BridgedTransport`; links
+between blocks are carried over a socket pair between the two workers. The
+coordinator (this process) drives the same phases as convergence_benchmark —
+bring-up, then link failures and recoveries — and polls every shard for LSDB
+digests to tell when the whole network has converged.
+
+    python sharded_simulation.py --topology grid --nodes 2500 --shards 8
+"""
+import asyncio
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import socket
+import time
+
+from convergence_benchmark import (
+    ConvergenceMonitor,
+    build_parser,
+    build_topology,
+    parameters,
+    throttle_options,
+    total_counters,
+)
+from lsn_async import LinkStateNode
+from tracing import write_chrome_trace
+from transport import BridgedTransport
+
+
+def partition(ids, edges, shards):
+    """Split `ids` into `shards` blocks of consecutive nodes in BFS order, so
+    most links stay inside one block. Returns node id -> shard."""
+    adjacency = {node: [] for node in ids}
+    for a, b in edges:
+        adjacency[a].append(b)
+        adjacency[b].append(a)
+    order, seen = [], set()
+    for start in ids:
+        if start in seen:
+            continue
+        seen.add(start)
+        queue = collections.deque([start])
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for neighbor in adjacency[node]:
+                if neighbor not in seen:
+                    seen.add(neighbor)
+                    queue.append(neighbor)
+    size = -(-len(order) // shards)
+    return {node: position // size for position, node in enumerate(order)}
+
+
+class Shard:
+    """The nodes one worker process hosts, driven by coordinator commands."""
+
+    def __init__(self, index, owner, control, sockets, args):
+        self.index = index
+        self.owner = owner
+        self.control = control
+        self.sockets = sockets
+        self.args = args
+        self.nodes = {}
+        self.transport = None
+        self.monitor = None
+        self.done = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.transport = BridgedTransport(
+            self.index,
+            self.owner,
+            latency=self.args.latency,
+            loss=self.args.loss,
+            seed=self.args.seed + self.index,
+        )
+        for shard, sock in self.sockets.items():
+            reader, writer = await asyncio.open_connection(sock=sock)
+            self.transport.add_bridge(shard, reader, writer)
+        for node_id, shard in self.owner.items():
+            if shard == self.index:
+                self.nodes[node_id] = LinkStateNode(
+                    node_id,
+                    wire_format=self.args.wire_format,
+                    transport=self.transport,
+                    hello_interval=self.args.hello_interval,
+                    dead_interval=self.args.dead_interval,
+                    lsa_interval=self.args.lsa_interval,
+                    **throttle_options(self.args),
+                )
+        for node in self.nodes.values():
+            if self.args.trace:
+                node.start_tracing(self.args.trace_capacity)
+            await node.turn_on()
+        self.monitor = ConvergenceMonitor(list(self.nodes.values()))
+
+        self.done = loop.create_future()
+        loop.add_reader(self.control.fileno(), self._on_control)
+        self.control.send(len(self.nodes))
+        await self.done
+        loop.remove_reader(self.control.fileno())
+
+    def _on_control(self):
+        while self.control.poll():
+            command, payload = self.control.recv()
+            asyncio.create_task(self._execute(command, payload))
+
+    async def _execute(self, command, payload):
+        result = await getattr(self, f"do_{command}")(*payload)
+        self.control.send(result)
+
+    async def do_add_links(self, links):
+        for a, b, cost in links:
+            await self.nodes[a].add_link(b, cost)
+
+    async def do_remove_link(self, a, b):
+        await self.nodes[a].remove_link(b)
+
+    async def do_originate(self, node_ids):
+        for node_id in node_ids:
+            await self.nodes[node_id].send_neighbor_lsa()
+        for node_id in node_ids:
+            await self.nodes[node_id].lsa_throttle.wait()
+        return {
+            node_id: self.nodes[node_id].lsdb.database[node_id].sequence_number
+            for node_id in node_ids
+        }
+
+    async def do_status(self, expected, required):
+        """Adjacencies that are up, whether every node holds `expected` LSAs
+        at least as new as `required`, and the distinct LSDB digests."""
+        complete = True
+        for node in self.nodes.values():
+            if len(node.lsdb) != expected:
+                complete = False
+                break
+            for router_id, sequence_number in required.items():
+                lsa = node.lsdb.database.get(router_id)
+                if lsa is None or lsa.sequence_number < sequence_number:
+                    complete = False
+                    break
+        digests = {self.monitor.digest(node) for node in self.nodes.values()}
+        adjacencies = sum(len(node.direct_connection) for node in self.nodes.values())
+        return adjacencies, complete, digests
+
+    async def do_stop(self):
+        counters = total_counters(self.nodes.values())
+        tracers = [node.stop_tracing() for node in self.nodes.values()]
+        for node in self.nodes.values():
+            await node.turn_off()
+        self.transport.close()
+        self.done.set_result(None)
+        return {
+            "messages": self.transport.writes,
+            "bytes": self.transport.bytes_sent,
+            "dropped_messages": self.transport.writes_dropped,
+            "counters": counters,
+            # perf_counter is a system-wide clock, so the spans of all shards
+            # can go into one trace.
+            "tracers": tracers if self.args.trace else [],
+        }
+
+
+def shard_main(index, owner, control, sockets, args):
+    logging.basicConfig(level=args.log_level.upper())
+    asyncio.run(Shard(index, owner, control, sockets, args).run())
+
+
+class Coordinator:
+    """Starts the shard processes and drives them through the benchmark."""
+
+    def __init__(self, args):
+        self.args = args
+        self.ids, self.edges, self.costs, self.failures = build_topology(args)
+        self.shards = max(1, min(args.shards, len(self.ids)))
+        self.owner = partition(self.ids, self.edges, self.shards)
+        self.controls = []
+        self.processes = []
+
+    def start(self):
+        sockets = [{} for _ in range(self.shards)]
+        for left in range(self.shards):
+            for right in range(left + 1, self.shards):
+                sockets[left][right], sockets[right][left] = socket.socketpair()
+        for index in range(self.shards):
+            control, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=shard_main,
+                args=(index, self.owner, child, sockets[index], self.args),
+                daemon=True,
+            )
+            process.start()
+            self.controls.append(control)
+            self.processes.append(process)
+        for shard_sockets in sockets:
+            for sock in shard_sockets.values():
+                sock.close()
+        # Every shard reports its node count once its nodes are listening.
+        return [control.recv() for control in self.controls]
+
+    def call(self, shard, command, *payload):
+        self.controls[shard].send((command, payload))
+        return self.controls[shard].recv()
+
+    def broadcast(self, command, *payload):
+        for control in self.controls:
+            control.send((command, payload))
+        return [control.recv() for control in self.controls]
+
+    def by_shard(self, items, key):
+        grouped = collections.defaultdict(list)
+        for item in items:
+            grouped[self.owner[key(item)]].append(item)
+        return grouped
+
+    def originate(self, node_ids):
+        grouped = self.by_shard(node_ids, lambda node_id: node_id)
+        for shard, members in grouped.items():
+            self.controls[shard].send(("originate", (members,)))
+        required = {}
+        for shard in grouped:
+            required.update(self.controls[shard].recv())
+        return required
+
+    def wait_adjacencies(self, count):
+        start = time.perf_counter()
+        while time.perf_counter() - start < self.args.timeout:
+            if sum(status[0] for status in self.broadcast("status", 0, {})) == count:
+                return True
+            time.sleep(self.args.poll_interval)
+        return False
+
+    def wait_converged(self, start, required):
+        expected = len(self.ids)
+        while time.perf_counter() - start < self.args.timeout:
+            statuses = self.broadcast("status", expected, required)
+            digests = set().union(*(status[2] for status in statuses))
+            if all(status[1] for status in statuses) and len(digests) == 1:
+                return time.perf_counter() - start
+            time.sleep(self.args.poll_interval)
+        return None
+
+    def measure(self, name, link, action):
+        start = time.perf_counter()
+        required = action()
+        elapsed = self.wait_converged(start, required)
+        result = {
+            "event": name,
+            "converged": elapsed is not None,
+            "convergence_seconds": elapsed,
+        }
+        if link is not None:
+            result["link"] = list(link)
+        return result
+
+    def run(self):
+        started = time.perf_counter()
+        shard_sizes = self.start()
+        adjacencies = 2 * len(self.edges)
+        events = []
+
+        def bring_up():
+            grouped = self.by_shard(
+                [(a, b, self.costs[(a, b)]) for a, b in self.edges], lambda link: link[0]
+            )
+            for shard, links in grouped.items():
+                self.controls[shard].send(("add_links", (links,)))
+            for shard in grouped:
+                self.controls[shard].recv()
+            self.wait_adjacencies(adjacencies)
+            return self.originate(self.ids)
+
+        events.append(self.measure("initial", None, bring_up))
+
+        for a, b in self.failures:
+
+            def fail():
+                self.call(self.owner[a], "remove_link", a, b)
+                self.wait_adjacencies(adjacencies - 2)
+                return self.originate([a, b])
+
+            def recover():
+                self.call(self.owner[a], "add_links", [(a, b, self.costs[(a, b)])])
+                self.wait_adjacencies(adjacencies)
+                return self.originate([a, b])
+
+            events.append(self.measure("link_down", (a, b), fail))
+            events.append(self.measure("link_up", (a, b), recover))
+
+        totals = self.broadcast("stop")
+        for process in self.processes:
+            process.join()
+
+        counters = collections.Counter()
+        for shard_totals in totals:
+            counters.update(shard_totals["counters"])
+        if self.args.trace:
+            write_chrome_trace(
+                self.args.trace,
+                [tracer for shard_totals in totals for tracer in shard_totals["tracers"]],
+            )
+        cross_shard = sum(1 for a, b in self.edges if self.owner[a] != self.owner[b])
+        return {
+            "benchmark": "sharded_convergence",
+            "topology": self.args.topology,
+            "nodes": len(self.ids),
+            "links": len(self.edges),
+            "shards": self.shards,
+            "nodes_per_shard": shard_sizes,
+            "cross_shard_links": cross_shard,
+            "parameters": parameters(self.args),
+            "events": events,
+            "messages": sum(shard_totals["messages"] for shard_totals in totals),
+            "bytes": sum(shard_totals["bytes"] for shard_totals in totals),
+            "dropped_messages": sum(
+                shard_totals["dropped_messages"] for shard_totals in totals
+            ),
+            "counters": dict(sorted(counters.items())),
+            "wall_seconds": time.perf_counter() - started,
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+        }
+
+
+def parse_args(argv=None):
+    parser = build_parser(__doc__.splitlines()[0])
+    parser.add_argument(
+        "--shards", type=int, default=os.cpu_count() or 1, help="worker processes"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper())
+    report = Coordinator(args).run()
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+import heapq
+
+INFINITY = float("inf")
+
+
+class ShortestPathTree:
+    """Shortest-path tree rooted at one router, maintained incrementally.
+
+    The tree is fed one LSA at a time through `update`. Only the part of the
+    tree that depends on the links that changed is recomputed, so a single LSA
+    costs work proportional to the affected routers instead of a full Dijkstra
+    run over the whole link state database.
+
+    A link is only used when both ends advertise it (two-way check) with a
+    positive cost; as in OSPF, costs start at 1, and a link with cost -1 is
+    down. All equal-cost next hops are kept for every destination.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.graph = {}
+        self.distance = {root: 0}
+        self.next_hops = {root: frozenset()}
+
+    def __str__(self):
+        return f"ShortestPathTree(root={self.root}, routes={self.routes()})"
+
+    def __repr__(self):
+        return str(self)
+
+    def route(self, destination):
+        if destination not in self.distance:
+            return None
+        return self.distance[destination], self.next_hops[destination]
+
+    def routes(self):
+        return {
+            destination: (cost, self.next_hops[destination])
+            for destination, cost in self.distance.items()
+            if destination != self.root
+        }
+
+    def update(self, router_id, link_state_packet):
+        """Apply the LSA of `router_id` (None when it was removed).
+
+        Returns the set of destinations whose cost or next hops changed.
+        """
+        new_links = {}
+        if link_state_packet is not None:
+            for link_id, cost in link_state_packet.links.pairs():
+                if link_id != router_id and cost > 0:
+                    new_links[link_id] = cost
+        old_links = self.graph.get(router_id, {})
+        if new_links == old_links:
+            return set()
+
+        changes = []
+        for neighbor in old_links.keys() | new_links.keys():
+            reverse = self.graph.get(neighbor, {}).get(router_id)
+            if reverse is None:
+                continue
+            before, after = old_links.get(neighbor), new_links.get(neighbor)
+            if before != after:
+                changes.append((router_id, neighbor, before, after))
+            before = reverse if neighbor in old_links else None
+            after = reverse if neighbor in new_links else None
+            if before != after:
+                changes.append((neighbor, router_id, before, after))
+
+        previous = self._invalidate(changes)
+        if new_links:
+            self.graph[router_id] = new_links
+        else:
+            self.graph.pop(router_id, None)
+        return self._apply(changes, previous)
+
+    def _successors(self, router_id):
+        for neighbor, cost in self.graph.get(router_id, {}).items():
+            if router_id in self.graph.get(neighbor, ()):
+                yield neighbor, cost
+
+    def _predecessors(self, router_id):
+        for neighbor in self.graph.get(router_id, ()):
+            cost = self.graph.get(neighbor, {}).get(router_id)
+            if cost is not None:
+                yield neighbor, cost
+
+    def _invalidate(self, changes):
+        # Routers whose shortest path used a link that got worse lose their
+        # distance, together with everything below them in the tree. This runs
+        # against the graph the current distances were computed on.
+        distance = self.distance
+        previous = {}
+        stack = [
+            v
+            for u, v, before, after in changes
+            if v != self.root
+            and before is not None
+            and u in distance
+            and (after is None or after > before)
+            and distance.get(u, INFINITY) + before == distance.get(v, INFINITY)
+        ]
+        while stack:
+            router_id = stack.pop()
+            if router_id in previous:
+                continue
+            previous[router_id] = distance[router_id]
+            for neighbor, cost in self._successors(router_id):
+                if (
+                    neighbor not in previous
+                    and neighbor != self.root
+                    and distance[router_id] + cost == distance.get(neighbor)
+                ):
+                    stack.append(neighbor)
+        for router_id in previous:
+            del distance[router_id]
+        return previous
+
+    def _apply(self, changes, previous):
+        distance = self.distance
+        heap = []
+        for router_id in previous:
+            best = min(
+                (
+                    distance[neighbor] + cost
+                    for neighbor, cost in self._predecessors(router_id)
+                    if neighbor in distance
+                ),
+                default=INFINITY,
+            )
+            if best < INFINITY:
+                distance[router_id] = best
+                heap.append((best, router_id))
+        for u, v, before, after in changes:
+            if after is not None and u in distance:
+                if distance[u] + after < distance.get(v, INFINITY):
+                    previous.setdefault(v, distance.get(v, INFINITY))
+                    distance[v] = distance[u] + after
+                    heap.append((distance[v], v))
+        heapq.heapify(heap)
+
+        while heap:
+            cost_so_far, router_id = heapq.heappop(heap)
+            if cost_so_far > distance.get(router_id, INFINITY):
+                continue
+            for neighbor, cost in self._successors(router_id):
+                if cost_so_far + cost < distance.get(neighbor, INFINITY):
+                    previous.setdefault(neighbor, distance.get(neighbor, INFINITY))
+                    distance[neighbor] = cost_so_far + cost
+                    heapq.heappush(heap, (distance[neighbor], neighbor))
+
+        changed = {
+            router_id
+            for router_id, cost in previous.items()
+            if distance.get(router_id, INFINITY) != cost
+        }
+        for router_id in previous:
+            if router_id not in distance:
+                self.next_hops.pop(router_id, None)
+
+        # Next hops are derived from the tight predecessors of each router, so
+        # they are refreshed in distance order starting at every router whose
+        # distance or set of incoming links changed.
+        candidates = set(previous)
+        candidates.update(v for _, v, _, _ in changes)
+        heap = [(distance[r], r) for r in candidates if r in distance]
+        heapq.heapify(heap)
+        done = set()
+        while heap:
+            cost_so_far, router_id = heapq.heappop(heap)
+            if router_id in done:
+                continue
+            done.add(router_id)
+            next_hops = self._compute_next_hops(router_id)
+            if next_hops != self.next_hops.get(router_id):
+                self.next_hops[router_id] = next_hops
+                changed.add(router_id)
+            if router_id not in changed:
+                continue
+            for neighbor, cost in self._successors(router_id):
+                if distance.get(neighbor) == cost_so_far + cost:
+                    heapq.heappush(heap, (distance[neighbor], neighbor))
+        return changed
+
+    def _compute_next_hops(self, router_id):
+        if router_id == self.root:
+            return frozenset()
+        distance = self.distance
+        next_hops = set()
+        for neighbor, cost in self._predecessors(router_id):
+            if distance.get(neighbor, INFINITY) + cost == distance[router_id]:
+                if neighbor == self.root:
+                    next_hops.add(router_id)
+                else:
+                    next_hops.update(self.next_hops.get(neighbor, ()))
+        return frozenset(next_hops)
@@ -0,0 +1,49 @@
+import random
+import time
+
+from duplicate_filter import DuplicateFilter
+
+
+def test_large_sequence_jumps_reset_the_window():
+    seen = DuplicateFilter(window=64)
+    seen.add((1, 5))
+    start = time.perf_counter()
+    seen.add((1, 2**62))
+    assert time.perf_counter() - start < 0.1
+    assert (1, 2**62) in seen
+    assert (1, 5) not in seen
+    assert (1, 2**62 - 1) not in seen
+    seen.add((1, 2**62 + 3))
+    assert (1, 2**62) in seen
+    assert (1, 2**62 + 3) in seen
+
+
+def test_sequence_numbers_below_the_window_are_not_seen():
+    seen = DuplicateFilter(window=8)
+    for sequence_number in range(20):
+        seen.add((1, sequence_number))
+    assert (1, 19) in seen
+    assert (1, 12) in seen
+    assert (1, 11) not in seen
+    assert (1, 0) not in seen
+    seen.add((1, 3))
+    assert (1, 3) not in seen
+    assert (2, 19) not in seen
+
+
+def test_matches_a_set_within_the_window():
+    rng = random.Random(0)
+    window = 16
+    seen = DuplicateFilter(window)
+    added = {}
+    for _ in range(5000):
+        link_state_id = rng.randrange(4)
+        highest = max(added.get(link_state_id, {0}))
+        sequence_number = max(0, highest + rng.randint(-20, 40))
+        state = (link_state_id, sequence_number)
+        seen.add(state)
+        added.setdefault(link_state_id, set()).add(sequence_number)
+        highest = max(added[link_state_id])
+        for candidate in range(highest - window - 5, highest + 5):
+            expected = highest - candidate < window and candidate in added[link_state_id]
+            assert ((link_state_id, candidate) in seen) == expected
@@ -0,0 +1,141 @@
+import random
+
+import pytest
+
+from ip_prefix_tree import FrozenIpPrefixTrie, IpPrefixTrie
+
+
+class ReferenceTable:
+    """Longest-prefix match by trying every prefix length, longest first."""
+
+    def __init__(self):
+        # (key, prefix_len) -> route names in insertion order
+        self.routes = {}
+
+    def insert(self, key, prefix_len, route_name):
+        names = self.routes.setdefault((key, prefix_len), [])
+        if route_name not in names:
+            names.append(route_name)
+
+    def remove(self, key, prefix_len, route_name):
+        names = self.routes.get((key, prefix_len), [])
+        if route_name in names:
+            names.remove(route_name)
+            if not names:
+                del self.routes[key, prefix_len]
+
+    def search(self, address):
+        for prefix_len in range(32, -1, -1):
+            key = address & IpPrefixTrie.mask(prefix_len)
+            names = self.routes.get((key, prefix_len))
+            if names:
+                return prefix_len, IpPrefixTrie.format_prefix(key, prefix_len), names[0]
+        return None
+
+
+def random_prefix(rng):
+    # Few distinct high bits, so prefixes nest and share branches often
+    key = rng.choice([0x0A000000, 0x0A010000, 0xC0A80000, 0xFFFFFF00, 0])
+    key |= rng.getrandbits(16)
+    prefix_len = rng.choice([0, 1, 8, 12, 15, 16, 17, 20, 24, 28, 31, 32])
+    return key & IpPrefixTrie.mask(prefix_len), prefix_len
+
+
+def probe_addresses(rng, table, count=40):
+    addresses = [rng.getrandbits(32) for _ in range(count // 2)]
+    for key, prefix_len in rng.sample(sorted(table.routes), min(count // 2, len(table.routes))):
+        end = key + (1 << (32 - prefix_len))
+        addresses += [key, end - 1, min(end, 0xFFFFFFFF), max(key - 1, 0)]
+    return addresses
+
+
+def assert_matches(trie, table, addresses, batch=True):
+    for address in addresses:
+        assert trie.search(IpPrefixTrie.int_to_ip(address)) == table.search(address)
+    if not batch:
+        return
+    prefix_lens, indexes = trie.search_many(addresses)
+    for address, prefix_len, index in zip(addresses, list(prefix_lens), list(indexes)):
+        expected = table.search(address)
+        if expected is None:
+            assert (prefix_len, index) == (-1, -1)
+        else:
+            assert prefix_len == expected[0]
+            assert trie.route(index) == expected
+
+
+@pytest.mark.parametrize("cache_size", [0, 256])
+@pytest.mark.parametrize("seed", range(6))
+def test_inserts_and_removals_match_a_reference(seed, cache_size):
+    rng = random.Random(seed)
+    trie = IpPrefixTrie(cache_size=cache_size)
+    table = ReferenceTable()
+    # A fixed pool, looked up every step so it stays cached across changes
+    pool = [rng.getrandbits(32) for _ in range(15)]
+    pool += [random_prefix(rng)[0] | rng.getrandbits(8) for _ in range(15)]
+    for step in range(400):
+        if table.routes and rng.random() < 0.45:
+            key, prefix_len = rng.choice(sorted(table.routes))
+            route_name = rng.choice(table.routes[key, prefix_len] + ["unknown"])
+            trie.remove(IpPrefixTrie.format_prefix(key, prefix_len), route_name)
+            table.remove(key, prefix_len, route_name)
+        else:
+            key, prefix_len = random_prefix(rng)
+            route_name = rng.choice(["a", "b", "c"])
+            trie.insert(IpPrefixTrie.format_prefix(key, prefix_len), route_name)
+            table.insert(key, prefix_len, route_name)
+        assert len(trie) == len(table.routes)
+        # search_many flattens the whole trie again after every change
+        assert_matches(trie, table, pool + probe_addresses(rng, table, 10), step % 25 == 0)
+    assert_matches(trie, table, probe_addresses(rng, table, 400))
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_bulk_load_matches_a_reference(ordered):
+    rng = random.Random(7)
+    table = ReferenceTable()
+    prefixes = []
+    for _ in range(2000):
+        key, prefix_len = random_prefix(rng)
+        route_name = rng.choice(["a", "b"])
+        prefixes.append((key, prefix_len, route_name))
+        table.insert(key, prefix_len, route_name)
+    if ordered:
+        prefixes.sort(key=lambda prefix: prefix[:2])
+        # Sorting reorders route names of the same prefix; keep the
+        # reference's first-wins order in step.
+        table = ReferenceTable()
+        for key, prefix_len, route_name in prefixes:
+            table.insert(key, prefix_len, route_name)
+    trie = IpPrefixTrie()
+    trie.bulk_load(prefixes)
+    assert len(trie) == len(table.routes)
+    assert_matches(trie, table, probe_addresses(rng, table, 2000))
+
+
+def test_frozen_image_matches_a_reference(tmp_path):
+    rng = random.Random(3)
+    trie = IpPrefixTrie()
+    table = ReferenceTable()
+    for _ in range(1000):
+        key, prefix_len = random_prefix(rng)
+        trie.insert(IpPrefixTrie.format_prefix(key, prefix_len), f"r{prefix_len}")
+        table.insert(key, prefix_len, f"r{prefix_len}")
+    path = tmp_path / "routes.img"
+    trie.freeze(path)
+    addresses = probe_addresses(rng, table, 1000)
+    with FrozenIpPrefixTrie(path) as frozen:
+        # Routes covered entirely by longer prefixes are left out of the image
+        assert len(frozen) <= len(table.routes)
+        for address in addresses:
+            assert frozen.search(IpPrefixTrie.int_to_ip(address)) == table.search(address)
+        prefix_lens, indexes = frozen.search_many(addresses)
+        for address, index in zip(addresses, list(indexes)):
+            expected = table.search(address)
+            assert (frozen.route(index) if index >= 0 else None) == expected
+
+
+@pytest.mark.parametrize("prefix", ["10.0.0.0/33", "256.0.0.0/8", "10.0.0/8", "10.0.0.0", "-1.0.0.0/8"])
+def test_invalid_prefixes_are_refused(prefix):
+    with pytest.raises(ValueError):
+        IpPrefixTrie.parse_prefix(prefix)
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+import lsn_async
+from link_state_database import Link, LinkStatePacket
+from lsdb_persistence import load_lsdb
+from lsn_async import LinkStateNode
+from transport import MemoryTransport
+
+
+def test_sequence_mark_moves_only_after_a_saved_snapshot(tmp_path, monkeypatch):
+    async def run():
+        node = LinkStateNode(
+            1,
+            transport=MemoryTransport(),
+            snapshot_path=str(tmp_path / "1.lsdb"),
+            lsa_min_hold=0,
+            lsa_max_hold=0,
+        )
+
+        def full_disk(*args):
+            raise OSError("disk full")
+
+        monkeypatch.setattr(lsn_async, "save_lsdb", full_disk)
+        await node.turn_on()
+        await node.send_neighbor_lsa()
+        await asyncio.sleep(0.05)
+        assert node.sequence_reserved == -1
+        assert 1 not in node.lsdb.database
+
+        monkeypatch.undo()
+        await node.send_neighbor_lsa()
+        await asyncio.sleep(0.05)
+        sequence_number = node.lsdb.database[1].sequence_number
+        assert sequence_number <= node.sequence_reserved
+        assert load_lsdb(node.snapshot_path).sequence_reserved == node.sequence_reserved
+        await node.turn_off()
+
+    asyncio.run(run())
+
+
+def test_unencodable_lsas_do_not_block_origination(tmp_path):
+    async def run():
+        node = LinkStateNode(
+            1,
+            transport=MemoryTransport(),
+            snapshot_path=str(tmp_path / "1.lsdb"),
+            lsa_min_hold=0,
+            lsa_max_hold=0,
+        )
+        await node.turn_on()
+        wide = 2**70
+        await node.lsdb.add(wide, LinkStatePacket(wide, 1, wide, [Link(1, 1)], 60))
+        await node.send_neighbor_lsa()
+        await asyncio.sleep(0.05)
+        assert 1 in node.lsdb.database
+        saved = load_lsdb(node.snapshot_path)
+        assert saved.sequence_reserved == node.sequence_reserved
+        assert [lsa["link_state_id"] for lsa in saved.lsas] == [1]
+        await node.turn_off()
+
+    asyncio.run(run())
+
+
+def test_snapshots_need_a_64_bit_router_id(tmp_path):
+    with pytest.raises(ValueError):
+        LinkStateNode(2**70, transport=MemoryTransport(), snapshot_path=str(tmp_path / "x"))
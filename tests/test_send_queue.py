@@ -0,0 +1,36 @@
+import asyncio
+
+import send_queue
+from lsn_async import LinkStateNode
+from transport import MemoryTransport
+
+
+def test_failed_writer_takes_the_adjacency_down(monkeypatch):
+    async def run():
+        transport = MemoryTransport()
+        nodes = [LinkStateNode(i, transport=transport) for i in (1, 2)]
+        for node in nodes:
+            await node.turn_on()
+        await nodes[0].add_link(2, 1)
+        await nodes[1].add_link(1, 1)
+        await asyncio.sleep(0.05)
+
+        def broken(*args):
+            raise RuntimeError("encoder bug")
+
+        monkeypatch.setattr(send_queue, "encode_lsa_frames", broken)
+        writer = nodes[0].direct_connection[2]
+        await nodes[0].add_prefix("10.1.0.0/16")
+        await asyncio.sleep(0.1)
+        assert writer not in nodes[0].send_queues
+        assert nodes[0].direct_links[2][1] == -1
+
+        monkeypatch.undo()
+        await nodes[0].add_link(2, 1)
+        await nodes[1].add_link(1, 1)
+        await asyncio.sleep(0.2)
+        assert nodes[1].lookup("10.1.2.3") == ("10.1.0.0/16", frozenset({1}))
+        for node in nodes:
+            await node.turn_off()
+
+    asyncio.run(run())
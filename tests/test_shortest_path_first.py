@@ -0,0 +1,92 @@
+import heapq
+import random
+
+import pytest
+
+from link_state_database import Link, LinkStatePacket
+from shortest_path_first import ShortestPathTree
+
+
+def full_dijkstra(root, lsas):
+    """Routes from scratch: two-way links with a positive cost only."""
+    advertised = {
+        router_id: {
+            link.link_id: link.cost
+            for link in lsa.links
+            if link.link_id != router_id and link.cost > 0
+        }
+        for router_id, lsa in lsas.items()
+    }
+    graph = {
+        router_id: {
+            neighbor: cost
+            for neighbor, cost in links.items()
+            if router_id in advertised.get(neighbor, {})
+        }
+        for router_id, links in advertised.items()
+    }
+    distance = {root: 0}
+    order = []
+    heap = [(0, root)]
+    while heap:
+        cost_so_far, router_id = heapq.heappop(heap)
+        if cost_so_far > distance[router_id] or router_id in order:
+            continue
+        order.append(router_id)
+        for neighbor, cost in graph.get(router_id, {}).items():
+            if cost_so_far + cost < distance.get(neighbor, float("inf")):
+                distance[neighbor] = cost_so_far + cost
+                heapq.heappush(heap, (distance[neighbor], neighbor))
+    next_hops = {root: frozenset()}
+    for router_id in order[1:]:
+        hops = set()
+        for neighbor, cost in graph[router_id].items():
+            if distance.get(neighbor, float("inf")) + graph[neighbor][router_id] == distance[router_id]:
+                hops.update([router_id] if neighbor == root else next_hops[neighbor])
+        next_hops[router_id] = frozenset(hops)
+    return distance, next_hops
+
+
+def random_lsa(rng, router_id, routers, sequence_number):
+    links = [
+        Link(neighbor, rng.choice([-1, 0, 1, 1, 2, 3, 5]))
+        for neighbor in rng.sample(routers, rng.randint(0, 4))
+    ]
+    return LinkStatePacket(router_id, sequence_number, router_id, links, 60)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_incremental_updates_match_full_dijkstra(seed):
+    rng = random.Random(seed)
+    routers = list(range(12))
+    root = 0
+    spf = ShortestPathTree(root)
+    lsas = {}
+    for step in range(150):
+        router_id = rng.choice(routers)
+        before = dict(spf.routes())
+        if router_id in lsas and rng.random() < 0.15:
+            del lsas[router_id]
+            changed = spf.update(router_id, None)
+        else:
+            lsas[router_id] = random_lsa(rng, router_id, routers, step)
+            changed = spf.update(router_id, lsas[router_id])
+
+        distance, next_hops = full_dijkstra(root, lsas)
+        assert spf.distance == distance
+        assert spf.next_hops == next_hops
+        after = spf.routes()
+        moved = {
+            destination
+            for destination in before.keys() | after.keys()
+            if before.get(destination) != after.get(destination)
+        }
+        assert moved <= changed
+
+
+def test_zero_cost_links_are_not_used():
+    spf = ShortestPathTree(1)
+    spf.update(1, LinkStatePacket(1, 0, 1, [Link(2, 1), Link(3, 0)], 60))
+    spf.update(2, LinkStatePacket(2, 0, 2, [Link(1, 1), Link(3, 1)], 60))
+    spf.update(3, LinkStatePacket(3, 0, 3, [Link(1, 0), Link(2, 1)], 60))
+    assert spf.routes() == {2: (1, frozenset({2})), 3: (2, frozenset({2}))}
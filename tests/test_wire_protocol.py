@@ -0,0 +1,282 @@
+import asyncio
+import struct
+
+import pytest
+
+import lsn_async
+from link_state_database import Link, LinkStatePacket
+from lsn_async import LinkStateNode
+from transport import MemoryTransport
+from wire_protocol import (
+    BINARY,
+    DB_SUMMARY,
+    FRAME_BUDGET,
+    FRAME_HEADER,
+    JSON,
+    LSA,
+    MAGIC,
+    MAX_FRAME_SIZE,
+    EncodedLsa,
+    decode_frame,
+    encode_lsa_frames,
+    encode_message,
+    encode_messages,
+    read_frame,
+    to_packet,
+)
+
+
+def read(data, limit=MAX_FRAME_SIZE):
+    async def run():
+        reader = asyncio.StreamReader(limit=limit)
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await read_frame(reader)
+
+    return asyncio.run(run())
+
+
+def read_all(data, limit):
+    async def run():
+        reader = asyncio.StreamReader(limit=limit)
+        reader.feed_data(data)
+        reader.feed_eof()
+        frames = []
+        while not reader.at_eof():
+            frames.append(await read_frame(reader))
+        return frames
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("encoding", [JSON, BINARY])
+def test_lsa_bursts_are_split_into_frames_within_the_budget(encoding):
+    lsas = [
+        {
+            "router_id": router_id,
+            "sequence_number": 1,
+            "link_state_id": router_id,
+            "links": [{"link_id": link_id, "cost": 1} for link_id in range(12)],
+            "prefixes": ["10.0.0.0/8"],
+            "ttl": 60,
+        }
+        for router_id in range(600)
+    ]
+    frames = encode_lsa_frames(7, [EncodedLsa(lsa) for lsa in lsas], encoding)
+    assert len(frames) > 1
+    assert all(len(frame) < FRAME_BUDGET + 1024 for frame in frames)
+
+    # Even a reader with the StreamReader default limit gets every LSA.
+    received = []
+    for frame in read_all(b"".join(frames), 2**16):
+        message = decode_frame(frame)
+        assert message["id"] == 7
+        received.extend(message["lsas"])
+    assert [lsa["link_state_id"] for lsa in received] == list(range(600))
+    assert to_packet(received[-1]).links[-1].link_id == 11
+
+
+def test_oversized_binary_frames_are_refused_before_reading_them():
+    with pytest.raises(ValueError):
+        read(FRAME_HEADER.pack(MAGIC, LSA, MAX_FRAME_SIZE + 1))
+
+
+def test_oversized_json_frames_overrun_the_reader_limit():
+    with pytest.raises(asyncio.LimitOverrunError):
+        read(b"{" + b" " * MAX_FRAME_SIZE + b"}\r\n")
+
+
+@pytest.mark.parametrize(
+    "frame, error",
+    [
+        (b"[1, 2]\r\n", ValueError),
+        (b"\xff\xfe\r\n", ValueError),
+        (FRAME_HEADER.pack(MAGIC, LSA, 2) + b"\x00\x01", struct.error),
+    ],
+)
+def test_malformed_frames_raise(frame, error):
+    with pytest.raises(error):
+        decode_frame(frame)
+
+
+def test_malformed_frame_takes_the_adjacency_down():
+    async def run():
+        transport = MemoryTransport()
+        nodes = [LinkStateNode(i, transport=transport) for i in (1, 2)]
+        for node in nodes:
+            await node.turn_on()
+        await nodes[0].add_link(2, 1)
+        await nodes[1].add_link(1, 1)
+        await asyncio.sleep(0.05)
+
+        nodes[1].direct_connection[1].write(b'{"type": "lsa"}\r\n')
+        await asyncio.sleep(0.05)
+        assert nodes[0].malformed_frames.value == 1
+        assert nodes[0].direct_links[2][1] == -1
+        assert nodes[1].direct_links[1][1] == -1
+
+        await nodes[0].add_link(2, 1)
+        await nodes[1].add_link(1, 1)
+        await asyncio.sleep(0.2)
+        assert nodes[0].routing_table() == {2: (1, frozenset({2}))}
+        assert nodes[1].routing_table() == {1: (1, frozenset({1}))}
+        for node in nodes:
+            await node.turn_off()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("encoding", [JSON, BINARY])
+def test_long_summaries_are_split_into_continued_parts(encoding):
+    headers = [
+        {"router_id": i, "link_state_id": i, "sequence_number": 3} for i in range(5000)
+    ]
+    frames = encode_messages({"type": "db_summary", "id": 1, "headers": headers}, encoding)
+    assert len(frames) > 1
+    assert all(len(frame) <= FRAME_BUDGET for frame in frames)
+
+    parts = [decode_frame(frame) for frame in frames]
+    assert [part.get("more", False) for part in parts] == [True] * (len(parts) - 1) + [False]
+    assert [header for part in parts for header in part["headers"]] == headers
+
+
+@pytest.mark.parametrize("wire_format", [JSON, BINARY])
+def test_returning_link_exchanges_a_large_lsdb_by_summary(wire_format):
+    async def run():
+        transport = MemoryTransport()
+        nodes = [LinkStateNode(i, transport=transport, wire_format=wire_format) for i in (1, 2)]
+        resyncs = []
+        for node in nodes:
+            node._handle_resync = lambda message, writer: resyncs.append(message)
+            await node.turn_on()
+        await nodes[0].add_link(2, 1)
+        await nodes[1].add_link(1, 1)
+        await asyncio.sleep(0.05)
+        nodes[1].direct_connection[1].write(b"[]\r\n")
+        await asyncio.sleep(0.05)
+        assert nodes[0].direct_links[2][1] == -1
+
+        # Far more than fits one frame while the link is down
+        for router_id in range(1000, 3000):
+            links = [Link(link_id, 1) for link_id in range(router_id, router_id + 5)]
+            await nodes[0].lsdb.add(router_id, LinkStatePacket(router_id, 1, router_id, links, 60))
+        await nodes[0].add_link(2, 1)
+        await nodes[1].add_link(1, 1)
+        await asyncio.sleep(0.5)
+        assert not resyncs
+        assert set(range(1000, 3000)) <= set(nodes[1].lsdb.database)
+        assert nodes[0].malformed_frames.value == 1
+        assert nodes[1].malformed_frames.value == 0
+        for node in nodes:
+            await node.turn_off()
+
+    asyncio.run(run())
+
+
+def test_prefixes_of_received_lsas_are_normalized():
+    lsa = {
+        "router_id": 3,
+        "sequence_number": 1,
+        "link_state_id": 3,
+        "links": [],
+        "prefixes": ["10.1.2.3/16"],
+        "ttl": 60,
+    }
+    assert to_packet(lsa).prefixes == ("10.1.0.0/16",)
+
+
+@pytest.mark.parametrize("prefix", ["10.0.0.0/40", "bad", "300.0.0.0/8", "10.0.0/8", 5])
+def test_lsas_with_bad_prefixes_are_refused_as_malformed(prefix):
+    async def run():
+        transport = MemoryTransport()
+        nodes = [LinkStateNode(i, transport=transport) for i in (1, 2)]
+        for node in nodes:
+            await node.turn_on()
+        await nodes[0].add_link(2, 1)
+        await nodes[1].add_link(1, 1)
+        await asyncio.sleep(0.05)
+
+        lsa = {
+            "router_id": 9,
+            "sequence_number": 1,
+            "link_state_id": 9,
+            "links": [],
+            "prefixes": [prefix],
+            "ttl": 60,
+        }
+        message = {"type": "lsa", "id": 2, "lsas": [lsa]}
+        nodes[1].direct_connection[1].write(encode_message(message))
+        await asyncio.sleep(0.05)
+        assert nodes[0].malformed_frames.value == 1
+        assert 9 not in nodes[0].lsdb.database
+        for node in nodes:
+            await node.turn_off()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("wire_format", [JSON, BINARY])
+def test_database_exchanges_send_each_missing_lsa_once(wire_format):
+    async def run():
+        transport = MemoryTransport()
+        nodes = [LinkStateNode(i, transport=transport, wire_format=wire_format) for i in (1, 2)]
+        received = {1: 0, 2: 0}
+        for node in nodes:
+            install_newer = node._install_newer
+
+            async def counted(lsas, writer, sender, node=node, install_newer=install_newer):
+                received[node.id] += sum(lsa["link_state_id"] >= 1000 for lsa in lsas)
+                return await install_newer(lsas, writer, sender)
+
+            node._install_newer = counted
+            await node.turn_on()
+        await nodes[0].add_link(2, 1)
+        await nodes[1].add_link(1, 1)
+        await asyncio.sleep(0.1)
+
+        # Started by the lower id, then by the higher one
+        for index, first in enumerate(nodes):
+            for router_id in range(1000 * (index + 1), 1000 * (index + 1) + 300):
+                links = [Link(router_id + 1, 1)]
+                await first.lsdb.add(router_id, LinkStatePacket(router_id, 1, router_id, links, 60))
+            received.update({1: 0, 2: 0})
+            other = nodes[1 - index]
+            # The connection the peer's hello came in on, as for a returning link
+            writer = next(
+                writer
+                for writer, capabilities in first.peer_capabilities.items()
+                if DB_SUMMARY in capabilities
+            )
+            await first._start_exchange(writer, other.id)
+            await asyncio.sleep(0.2)
+            assert received == {first.id: 0, other.id: 300}
+        for node in nodes:
+            await node.turn_off()
+
+    asyncio.run(run())
+
+
+def test_endless_message_parts_are_refused_as_malformed(monkeypatch):
+    monkeypatch.setattr(lsn_async, "MAX_JOINED_ENTRIES", 100)
+
+    async def run():
+        transport = MemoryTransport()
+        nodes = [LinkStateNode(i, transport=transport) for i in (1, 2)]
+        for node in nodes:
+            await node.turn_on()
+        await nodes[0].add_link(2, 1)
+        await nodes[1].add_link(1, 1)
+        await asyncio.sleep(0.05)
+
+        headers = [{"router_id": i, "link_state_id": i, "sequence_number": 1} for i in range(30)]
+        part = {"type": "db_summary", "id": 2, "headers": headers, "more": True}
+        for _ in range(5):
+            nodes[1].direct_connection[1].write(encode_message(part))
+        await asyncio.sleep(0.05)
+        assert nodes[0].malformed_frames.value == 1
+        assert not nodes[0].partial_messages
+        assert nodes[0].direct_links[2][1] == -1
+        for node in nodes:
+            await node.turn_off()
+
+    asyncio.run(run())
@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+
+class Throttle:
+    """Hold-down with exponential backoff for work triggered by bursts.
+
+    The first `request` after a quiet period returns True: the caller runs
+    the work itself, right away. Requests that follow within the hold time
+    return False and are coalesced into one call of `action` at the end of
+    it, and every such held-down run doubles the hold time, up to
+    `max_hold`. Once no request has come for a whole hold time it drops back
+    to `min_hold`.
+
+    `action` may be a plain function or a coroutine function, which then runs
+    as a task. A `min_hold` of 0 disables throttling.
+    """
+
+    def __init__(
+        self,
+        action,
+        min_hold: float = 0.05,
+        max_hold: float = 5.0,
+    ):
+        self.action = action
+        self.min_hold = min_hold
+        self.max_hold = max(min_hold, max_hold)
+        self.hold = min_hold
+        self.last_run = None
+        self.timer = None
+        self.task = None
+        self.runs = 0
+        self.coalesced = 0
+
+    def request(self):
+        """Ask for a run; True means the caller should do the work now."""
+        if self.timer is not None:
+            self.coalesced += 1
+            return False
+        now = time.monotonic()
+        if self.last_run is not None and now - self.last_run < self.hold:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.last_run + self.hold - now, self._fire
+            )
+            self.hold = min(2 * self.hold, self.max_hold)
+            return False
+        self.hold = self.min_hold
+        self.last_run = now
+        self.runs += 1
+        return True
+
+    def _fire(self):
+        self.timer = None
+        self.last_run = time.monotonic()
+        self.runs += 1
+        result = self.action()
+        if asyncio.iscoroutine(result):
+            self.task = asyncio.create_task(result)
+
+    def flush(self):
+        """Run a held-down action now instead of when its hold time ends."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self._fire()
+
+    async def wait(self):
+        """Wait until no run is held down or in progress."""
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.timer is not None:
+                await asyncio.sleep(max(0.0, self.timer.when() - loop.time()))
+            elif self.task is not None and not self.task.done():
+                await asyncio.wait([self.task])
+            else:
+                return
+
+    def cancel(self):
+        """Drop a held-down run; the backoff state is kept."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
@@ -0,0 +1,76 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class DeadlineHeap:
+    """Deadlines for many keys driven by a single event loop timer.
+
+    Deadlines are `time.monotonic()` values. Rescheduling or cancelling a key
+    only updates a dict; superseded heap entries are skipped when they reach
+    the top, so firing costs O(log n) per expired key and nothing runs while no
+    deadline is due. `callback(key)` is called for every key whose latest
+    deadline has passed.
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.deadlines = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.timer = None
+        self.timer_deadline = None
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def schedule(self, key, deadline):
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, next(self.counter), key))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [
+                (deadline, next(self.counter), key)
+                for key, deadline in self.deadlines.items()
+            ]
+            heapq.heapify(self.heap)
+        self._arm()
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.deadlines.clear()
+        self.heap.clear()
+
+    def _arm(self):
+        if not self.heap:
+            return
+        deadline = self.heap[0][0]
+        if self.timer is not None:
+            if self.timer_deadline <= deadline:
+                return
+            self.timer.cancel()
+        self.timer = asyncio.get_running_loop().call_later(
+            max(0.0, deadline - time.monotonic()), self._fire
+        )
+        self.timer_deadline = deadline
+
+    def _fire(self):
+        self.timer = None
+        now = time.monotonic()
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self.heap)
+            if self.deadlines.get(key) == deadline:
+                del self.deadlines[key]
+                expired.append(key)
+        self._arm()
+        for key in expired:
+            self.callback(key)
@@ -0,0 +1,166 @@
+"""Span recording for LinkStateNodes and export as Chrome trace JSON.
+
+A node with a `TraceRecorder` (`node.start_tracing()`) records a span for each
+stage of the message pipeline: decoding a frame, handling the message,
+installing an LSA, flooding it, SPF runs, originations, and the writes and
+drains of every send queue. Call sites test `node.tracer is not None` before
+they read the clock, so a node that is not tracing pays one attribute check per
+stage.
+
+`write_chrome_trace` writes the spans of any number of recorders in the Chrome
+trace event format, which chrome://tracing and https://ui.perfetto.dev open.
+Every node is a process and every track (a connection's reader, a send queue)
+a thread. Spans that install an LSA are joined by a flow arrow to the span on
+the sending node that installed or originated the same (link_state_id,
+sequence_number), so one LSA can be followed hop by hop across a simulation.
+
+    tracers = [node.start_tracing() for node in nodes]
+    ...
+    write_chrome_trace("trace.json", tracers)
+"""
+import json
+import time
+
+# Spans after which a node holds an LSA it may flood on
+STORES = ("install", "originate")
+
+
+class TraceRecorder:
+    """Ring buffer of the last `capacity` spans recorded on one node.
+
+    A span is (track, name, start, end, args) with `time.perf_counter()`
+    times. Spans on one track should not overlap, so a track is one sequential
+    pipeline such as the reader loop of a connection.
+    """
+
+    def __init__(self, node_id, capacity: int = 65536):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.node_id = node_id
+        self.capacity = capacity
+        self.spans = [None] * capacity
+        self.recorded = 0
+
+    def __len__(self):
+        return min(self.recorded, self.capacity)
+
+    def __str__(self):
+        return (
+            f"TraceRecorder(node_id={self.node_id}, spans={len(self)}, "
+            f"dropped={self.dropped})"
+        )
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def dropped(self):
+        """Spans overwritten because the buffer was full."""
+        return max(0, self.recorded - self.capacity)
+
+    def record(self, track, name, start, end=None, args=None):
+        if end is None:
+            end = time.perf_counter()
+        self.spans[self.recorded % self.capacity] = (track, name, start, end, args)
+        self.recorded += 1
+
+    def snapshot(self):
+        """The retained spans, oldest first."""
+        if self.recorded <= self.capacity:
+            return self.spans[: self.recorded]
+        split = self.recorded % self.capacity
+        return self.spans[split:] + self.spans[:split]
+
+    def clear(self):
+        self.spans = [None] * self.capacity
+        self.recorded = 0
+
+    def write_chrome_trace(self, path):
+        write_chrome_trace(path, [self])
+
+
+def chrome_trace(recorders):
+    """Return the spans of `recorders` as a Chrome trace JSON object."""
+    events = []
+    # (node, link_state_id, sequence_number) -> (tid, ts) of the first store
+    stored = {}
+    hops = []
+    for recorder in recorders:
+        pid = recorder.node_id
+        events.append(
+            {
+                "ph": "M",
+                "name": "process_name",
+                "pid": pid,
+                "tid": 0,
+                "args": {"name": f"node {pid}"},
+            }
+        )
+        tids = {}
+        for track, name, start, end, args in recorder.snapshot():
+            tid = tids.get(track)
+            if tid is None:
+                tid = tids[track] = len(tids) + 1
+                events.append(
+                    {
+                        "ph": "M",
+                        "name": "thread_name",
+                        "pid": pid,
+                        "tid": tid,
+                        "args": {"name": str(track)},
+                    }
+                )
+            ts = start * 1e6
+            event = {
+                "ph": "X",
+                "name": name,
+                "cat": "lsr",
+                "pid": pid,
+                "tid": tid,
+                "ts": ts,
+                "dur": (end - start) * 1e6,
+            }
+            if args:
+                event["args"] = args
+                if name in STORES:
+                    key = (pid, args["lsid"], args["seq"])
+                    stored.setdefault(key, (tid, ts))
+                    if "from" in args:
+                        hops.append((args["from"], args["lsid"], args["seq"], pid, tid, ts))
+            events.append(event)
+
+    for flow_id, (sender, lsid, seq, pid, tid, ts) in enumerate(hops):
+        origin = stored.get((sender, lsid, seq))
+        if origin is None:
+            # The sender was not traced or its span was overwritten.
+            continue
+        name = f"lsa {lsid}:{seq}"
+        events.append(
+            {
+                "ph": "s",
+                "id": flow_id,
+                "name": name,
+                "cat": "lsa",
+                "pid": sender,
+                "tid": origin[0],
+                "ts": origin[1],
+            }
+        )
+        events.append(
+            {
+                "ph": "f",
+                "bp": "e",
+                "id": flow_id,
+                "name": name,
+                "cat": "lsa",
+                "pid": pid,
+                "tid": tid,
+                "ts": ts,
+            }
+        )
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def write_chrome_trace(path, recorders):
+    with open(path, "w") as output:
+        json.dump(chrome_trace(recorders), output)
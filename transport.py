@@ -0,0 +1,343 @@
+"""Transports that connect LinkStateNodes to each other.
+
+A transport has two coroutines: `listen(address, handler)`, which returns a
+server object with `close()` and `wait_closed()`, and `connect(address)`, which
+returns a `(reader, writer)` pair. Readers are `asyncio.StreamReader`s and
+writers provide the subset of `asyncio.StreamWriter` the nodes use: `write`,
+`drain`, `close`, `is_closing` and `get_extra_info`.
+"""
+import asyncio
+import collections
+import itertools
+import random
+import struct
+
+from wire_protocol import MAX_FRAME_SIZE
+
+
+class TcpTransport:
+    """Real TCP sockets; node ids are used as port numbers on `host`."""
+
+    def __init__(self, host="localhost"):
+        self.host = host
+
+    async def listen(self, address, handler):
+        return await asyncio.start_server(
+            handler, self.host, address, limit=MAX_FRAME_SIZE
+        )
+
+    async def connect(self, address):
+        return await asyncio.open_connection(self.host, address, limit=MAX_FRAME_SIZE)
+
+
+class MemoryTransport:
+    """In-process channels between nodes running on the same event loop.
+
+    Bytes written on one end are fed to the reader on the other end after
+    `latency` seconds, in order. Each write is dropped as a whole with
+    probability `loss`, which loses whole frames since nodes write one frame at
+    a time. All nodes that should reach each other must share one instance.
+    """
+
+    def __init__(self, latency: float = 0.0, loss: float = 0.0, seed=None):
+        self.latency = latency
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.listeners = {}
+        self.connection_ids = itertools.count()
+        self.writes = 0
+        self.bytes_sent = 0
+        self.writes_dropped = 0
+
+    async def listen(self, address, handler):
+        if address in self.listeners:
+            raise OSError(f"Address {address} is already in use")
+        server = MemoryServer(self, address, handler)
+        self.listeners[address] = server
+        return server
+
+    async def connect(self, address):
+        server = self.listeners.get(address)
+        if server is None:
+            raise ConnectionRefusedError(f"Nothing is listening on {address}")
+        client_reader = asyncio.StreamReader(limit=MAX_FRAME_SIZE)
+        server_reader = asyncio.StreamReader(limit=MAX_FRAME_SIZE)
+        client_writer = MemoryStreamWriter(self, server_reader, address)
+        server_writer = MemoryStreamWriter(
+            self, client_reader, ("memory", next(self.connection_ids))
+        )
+        client_writer.peer = server_writer
+        server_writer.peer = client_writer
+        server.accept(server_reader, server_writer)
+        return client_reader, client_writer
+
+
+class MemoryServer:
+    def __init__(self, transport, address, handler):
+        self.transport = transport
+        self.address = address
+        self.handler = handler
+        self.tasks = set()
+
+    def accept(self, reader, writer):
+        task = asyncio.create_task(self.handler(reader, writer))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def close(self):
+        if self.transport.listeners.get(self.address) is self:
+            del self.transport.listeners[self.address]
+
+    async def wait_closed(self):
+        pass
+
+
+class MemoryStreamWriter:
+    def __init__(self, transport, peer_reader, peername):
+        self.transport = transport
+        self.peer_reader = peer_reader
+        self.peername = peername
+        self.peer = None
+        self.closed = False
+        self.in_flight = collections.deque()
+        self.timer = None
+
+    def write(self, data):
+        if self.closed:
+            return
+        transport = self.transport
+        transport.writes += 1
+        transport.bytes_sent += len(data)
+        if transport.loss and transport.random.random() < transport.loss:
+            transport.writes_dropped += 1
+            return
+        self._send(bytes(data))
+
+    async def drain(self):
+        # Nothing is buffered on this side; just give the loop a chance to run
+        # like a real drain would.
+        await asyncio.sleep(0)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # Our own reader sees EOF right away, the peer once in-flight data
+        # has been delivered.
+        self.peer.peer_reader.feed_eof()
+        self._send(None)
+
+    def is_closing(self):
+        return self.closed
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return self.peername
+        return default
+
+    def _send(self, data):
+        loop = asyncio.get_running_loop()
+        self.in_flight.append((loop.time() + self.transport.latency, data))
+        if self.timer is None:
+            self.timer = loop.call_at(self.in_flight[0][0], self._deliver)
+
+    def _deliver(self):
+        loop = asyncio.get_running_loop()
+        self.timer = None
+        now = loop.time()
+        while self.in_flight and self.in_flight[0][0] <= now:
+            _, data = self.in_flight.popleft()
+            if self.peer.closed:
+                # The peer closed its end, which already ended its reader.
+                continue
+            if data is None:
+                self.peer_reader.feed_eof()
+                self.peer.closed = True
+            else:
+                self.peer_reader.feed_data(data)
+        if self.in_flight:
+            self.timer = loop.call_at(self.in_flight[0][0], self._deliver)
+
+
+class BridgedTransport(MemoryTransport):
+    """A MemoryTransport for one shard of a simulation split over processes.
+
+    `owner` maps every node id to the shard hosting it. Connections to nodes
+    on this shard stay in memory; connections to other shards are carried
+    over the `Bridge` to that shard, set up with `add_bridge`.
+    """
+
+    def __init__(self, shard, owner, latency: float = 0.0, loss: float = 0.0, seed=None):
+        super().__init__(latency, loss, seed)
+        self.shard = shard
+        self.owner = owner
+        self.bridges = {}
+
+    def add_bridge(self, shard, reader, writer):
+        bridge = self.bridges[shard] = Bridge(self, shard, reader, writer)
+        bridge.start()
+        return bridge
+
+    async def connect(self, address):
+        shard = self.owner.get(address, self.shard)
+        if shard == self.shard:
+            return await super().connect(address)
+        return self.bridges[shard].open(address)
+
+    def close(self):
+        for bridge in self.bridges.values():
+            bridge.close()
+
+
+# frame kind, connection id, payload length
+BRIDGE_HEADER = struct.Struct("!BqI")
+BRIDGE_ADDRESS = struct.Struct("!q")
+OPEN = 1
+DATA = 2
+CLOSE = 3
+
+
+class Bridge:
+    """Multiplexes node connections between two shards over one stream pair.
+
+    Each connection gets an id picked by the shard that opened it (even on
+    the lower-numbered shard, odd on the other one) and is carried as OPEN,
+    DATA and CLOSE frames. Frames to the other shard are delayed by the
+    transport latency, like in-memory writes.
+    """
+
+    def __init__(self, transport, shard, reader, writer):
+        self.transport = transport
+        self.shard = shard
+        self.reader = reader
+        self.writer = writer
+        self.connection_ids = itertools.count(
+            0 if transport.shard < shard else 1, 2
+        )
+        self.channels = {}
+        self.in_flight = collections.deque()
+        self.timer = None
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def open(self, address):
+        connection_id = next(self.connection_ids)
+        reader, writer = self._channel(connection_id, address)
+        self.send(OPEN, connection_id, BRIDGE_ADDRESS.pack(address))
+        return reader, writer
+
+    def _channel(self, connection_id, peername):
+        reader = asyncio.StreamReader(limit=MAX_FRAME_SIZE)
+        writer = BridgedStreamWriter(self, connection_id, reader, peername)
+        self.channels[connection_id] = writer
+        return reader, writer
+
+    def send(self, kind, connection_id, payload=b""):
+        frame = BRIDGE_HEADER.pack(kind, connection_id, len(payload)) + payload
+        if not self.transport.latency:
+            self.writer.write(frame)
+            return
+        loop = asyncio.get_running_loop()
+        self.in_flight.append((loop.time() + self.transport.latency, frame))
+        if self.timer is None:
+            self.timer = loop.call_at(self.in_flight[0][0], self._deliver)
+
+    def _deliver(self):
+        loop = asyncio.get_running_loop()
+        self.timer = None
+        now = loop.time()
+        while self.in_flight and self.in_flight[0][0] <= now:
+            self.writer.write(self.in_flight.popleft()[1])
+        if self.in_flight:
+            self.timer = loop.call_at(self.in_flight[0][0], self._deliver)
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def run(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(BRIDGE_HEADER.size)
+                kind, connection_id, length = BRIDGE_HEADER.unpack(header)
+                payload = await self.reader.readexactly(length) if length else b""
+                if kind == OPEN:
+                    self._accept(connection_id, BRIDGE_ADDRESS.unpack(payload)[0])
+                elif kind == DATA:
+                    channel = self.channels.get(connection_id)
+                    if channel is not None:
+                        channel.reader.feed_data(payload)
+                elif kind == CLOSE:
+                    channel = self.channels.pop(connection_id, None)
+                    if channel is not None:
+                        channel.closed = True
+                        channel.reader.feed_eof()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            for channel in self.channels.values():
+                channel.closed = True
+                channel.reader.feed_eof()
+            self.channels.clear()
+
+    def _accept(self, connection_id, address):
+        server = self.transport.listeners.get(address)
+        if server is None:
+            self.send(CLOSE, connection_id)
+            return
+        reader, writer = self._channel(connection_id, ("shard", self.shard, connection_id))
+        server.accept(reader, writer)
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.task is not None:
+            self.task.cancel()
+        self.writer.close()
+
+
+class BridgedStreamWriter:
+    """Writer end of one node connection carried over a `Bridge`."""
+
+    def __init__(self, bridge, connection_id, reader, peername):
+        self.bridge = bridge
+        self.connection_id = connection_id
+        self.reader = reader
+        self.peername = peername
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            return
+        transport = self.bridge.transport
+        transport.writes += 1
+        transport.bytes_sent += len(data)
+        if transport.loss and transport.random.random() < transport.loss:
+            transport.writes_dropped += 1
+            return
+        self.bridge.send(DATA, self.connection_id, bytes(data))
+
+    async def drain(self):
+        # Backpressure comes from the stream between the two shards.
+        await self.bridge.drain()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.reader.feed_eof()
+        if self.bridge.channels.pop(self.connection_id, None) is not None:
+            self.bridge.send(CLOSE, self.connection_id)
+
+    def is_closing(self):
+        return self.closed
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername":
+            return self.peername
+        return default
@@ -0,0 +1,512 @@
+"""Framing and encoding of the messages exchanged between LinkStateNodes.
+
+Two encodings share one stream. JSON messages are a JSON object terminated by
+CRLF. Binary messages are length-prefixed frames that start with `MAGIC`, a
+byte that can never open a JSON object, so a reader can tell them apart from
+the first byte. Nodes only send binary frames to peers that advertised the
+`BINARY` capability in their hello.
+"""
+import json
+import struct
+from array import array
+from collections.abc import Mapping
+
+from ip_prefix_tree import IpPrefixTrie
+from link_state_database import LinkStatePacket, Links
+
+JSON = "json"
+# binary/2 added the advertised prefixes to LSA records, binary/3 the MORE and
+# REPLY flags
+BINARY = "binary/3"
+# Peers that advertise this understand db_summary/ls_request/ls_update
+DB_SUMMARY = "db_summary"
+
+MAGIC = 0xA5
+# Longest frame a reader accepts, in either encoding. Readers must be created
+# with at least this limit, since a JSON frame is read as one line.
+MAX_FRAME_SIZE = 1 << 20
+# Entries the parts of one message split with "more" may add up to, which
+# bounds what a peer can make a reader buffer
+MAX_JOINED_ENTRIES = 1 << 18
+# Bytes of LSAs a sender packs into one frame before starting the next
+FRAME_BUDGET = 32 * 1024
+
+HELLO = 1
+LSA = 2
+RESYNC = 3
+SUMMARY = 4
+REQUEST = 5
+UPDATE = 6
+
+MESSAGE_TYPES = {
+    "hello": HELLO,
+    "lsa": LSA,
+    "resync": RESYNC,
+    "db_summary": SUMMARY,
+    "ls_request": REQUEST,
+    "ls_update": UPDATE,
+}
+MESSAGE_NAMES = {value: key for key, value in MESSAGE_TYPES.items()}
+# Set in the message type byte of every part of a split message but the last
+MORE = 0x80
+# Set in the message type byte of a db_summary that answers the peer's own
+REPLY = 0x40
+
+# List field that `encode_messages` splits a long message on
+SPLIT_FIELDS = {
+    "lsa": "lsas",
+    "resync": "lsas",
+    "db_summary": "headers",
+    "ls_request": "link_state_ids",
+    "ls_update": "lsas",
+}
+# Messages whose parts are flagged "more" and must be handled as one; the parts
+# of the others are complete messages on their own.
+CONTINUED = ("resync", "db_summary")
+
+# magic, message type, payload length
+FRAME_HEADER = struct.Struct("!BBI")
+# sender id, cost, length of the comma separated capability list
+HELLO_HEADER = struct.Struct("!qiH")
+# sender id, number of LSAs
+LSA_LIST_HEADER = struct.Struct("!qH")
+# router_id, sequence_number, link_state_id, ttl, number of links, number of prefixes
+LSA_HEADER = struct.Struct("!qqqiHH")
+# link_id, cost
+LINK = struct.Struct("!qi")
+# number of links -> Struct unpacking that many links at once
+LINK_BLOCKS = {}
+# network address, prefix length
+PREFIX = struct.Struct("!IB")
+# sender id, number of entries
+ENTRY_LIST_HEADER = struct.Struct("!qI")
+# router_id, link_state_id, sequence_number
+LSA_SUMMARY = struct.Struct("!qqq")
+# link_state_id
+LINK_STATE_ID = struct.Struct("!q")
+
+
+def encode_message(message, encoding=JSON):
+    """Encode `message` as one frame ready to be written to a stream.
+
+    Messages that cannot be represented in the binary encoding (unknown types,
+    non-integer ids) silently fall back to JSON.
+    """
+    if encoding == BINARY:
+        try:
+            return encode_binary(message)
+        except (KeyError, TypeError, ValueError, struct.error):
+            pass
+    return (json.dumps(message, default=_to_json) + "\r\n").encode()
+
+
+def encode_messages(message, encoding=JSON, budget=FRAME_BUDGET):
+    """Encode `message` as frames of about `budget` bytes or less.
+
+    A longer message is split on its `SPLIT_FIELDS` list. The parts of
+    `CONTINUED` messages carry "more": True up to the last one; the receiver
+    joins them again before handling the message.
+    """
+    frame = encode_message(message, encoding)
+    field = SPLIT_FIELDS.get(message["type"])
+    if len(frame) <= budget or field is None or len(message[field]) < 2:
+        return [frame]
+    # Split evenly by the number of entries, then split again any part whose
+    # entries happened to be larger than average.
+    entries = message[field]
+    parts = min(len(entries), -(-len(frame) // budget))
+    size = -(-len(entries) // parts)
+    frames = []
+    for start in range(0, len(entries), size):
+        part = dict(message)
+        part[field] = entries[start:start + size]
+        if message["type"] in CONTINUED and (
+            start + size < len(entries) or message.get("more")
+        ):
+            part["more"] = True
+        else:
+            part.pop("more", None)
+        frames.extend(encode_messages(part, encoding, budget))
+    return frames
+
+
+def _to_json(value):
+    if isinstance(value, LsaRecord):
+        return value.to_dict()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def encode_binary(message):
+    message_type = MESSAGE_TYPES[message["type"]]
+    if message_type == HELLO:
+        capabilities = ",".join(message.get("capabilities", ())).encode()
+        payload = (
+            HELLO_HEADER.pack(message["id"], message["cost"], len(capabilities))
+            + capabilities
+        )
+    elif message_type == SUMMARY:
+        headers = message["headers"]
+        parts = [ENTRY_LIST_HEADER.pack(message["id"], len(headers))]
+        for header in headers:
+            parts.append(
+                LSA_SUMMARY.pack(
+                    header["router_id"],
+                    header["link_state_id"],
+                    header["sequence_number"],
+                )
+            )
+        payload = b"".join(parts)
+    elif message_type == REQUEST:
+        link_state_ids = message["link_state_ids"]
+        parts = [ENTRY_LIST_HEADER.pack(message["id"], len(link_state_ids))]
+        for link_state_id in link_state_ids:
+            parts.append(LINK_STATE_ID.pack(link_state_id))
+        payload = b"".join(parts)
+    else:
+        parts = [LSA_LIST_HEADER.pack(message["id"], len(message["lsas"]))]
+        for lsa in message["lsas"]:
+            parts.append(encode_lsa(lsa))
+        payload = b"".join(parts)
+    if message.get("more"):
+        message_type |= MORE
+    if message.get("reply"):
+        message_type |= REPLY
+    return FRAME_HEADER.pack(MAGIC, message_type, len(payload)) + payload
+
+
+def encode_lsa(lsa):
+    if isinstance(lsa, LsaRecord):
+        return lsa.raw()
+    links = lsa["links"]
+    prefixes = lsa.get("prefixes", ())
+    parts = [
+        LSA_HEADER.pack(
+            lsa["router_id"],
+            lsa["sequence_number"],
+            lsa["link_state_id"],
+            lsa["ttl"],
+            len(links),
+            len(prefixes),
+        )
+    ]
+    for link in links:
+        parts.append(LINK.pack(link["link_id"], link["cost"]))
+    for prefix in prefixes:
+        parts.append(PREFIX.pack(*IpPrefixTrie.parse_prefix(prefix)))
+    return b"".join(parts)
+
+
+class EncodedLsa:
+    """An LSA dict that keeps its encoded bodies, one per encoding.
+
+    The same instance is queued to every neighbor it is flooded to, so each
+    LSA is serialized at most once per encoding however many peers get it.
+    """
+
+    __slots__ = ("lsa", "bodies")
+
+    def __init__(self, lsa):
+        self.lsa = lsa
+        self.bodies = {}
+
+    @property
+    def link_state_id(self):
+        return self.lsa["link_state_id"]
+
+    @property
+    def sequence_number(self):
+        return self.lsa["sequence_number"]
+
+    def body(self, encoding):
+        body = self.bodies.get(encoding)
+        if body is None:
+            if encoding == BINARY:
+                body = encode_lsa(self.lsa)
+            else:
+                body = json.dumps(self.lsa, default=_to_json).encode()
+            self.bodies[encoding] = body
+        return body
+
+
+def encode_lsa_frames(sender, items, encoding=JSON, message_type="lsa", budget=FRAME_BUDGET):
+    """Pack `EncodedLsa` items into frames, reusing their cached bodies.
+
+    A frame is closed once its LSAs reach `budget` bytes, so a large burst
+    never comes near a reader's `MAX_FRAME_SIZE`. Every frame holds at least
+    one LSA.
+    """
+    if encoding == BINARY:
+        try:
+            bodies = [item.body(BINARY) for item in items]
+            message_type = MESSAGE_TYPES[message_type]
+        except (KeyError, TypeError, ValueError, struct.error):
+            pass
+        else:
+            frames = []
+            # The LSA count is 16 bits wide
+            for batch in _batches(bodies, budget, 0xFFFF):
+                payload = LSA_LIST_HEADER.pack(sender, len(batch)) + b"".join(batch)
+                frames.append(FRAME_HEADER.pack(MAGIC, message_type, len(payload)) + payload)
+            return frames
+    head = b'{"type": %s, "id": %s, "lsas": [' % (
+        json.dumps(message_type).encode(),
+        json.dumps(sender).encode(),
+    )
+    return [
+        head + b", ".join(batch) + b"]}\r\n"
+        for batch in _batches([item.body(JSON) for item in items], budget)
+    ]
+
+
+def _batches(bodies, budget, limit=None):
+    """Split `bodies` into runs of at most `budget` bytes and `limit` bodies;
+    a body larger than `budget` gets a run of its own."""
+    batch = []
+    size = 0
+    for body in bodies:
+        if batch and (size + len(body) > budget or len(batch) == limit):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(body)
+        size += len(body)
+    if batch:
+        yield batch
+
+
+class LsaRecord(Mapping):
+    """A binary LSA record read in place from a received frame.
+
+    Only the fixed header is unpacked up front, so an LSA that turns out to be
+    a duplicate or stale costs no further objects. It reads like an LSA dict;
+    "links" and "prefixes" are decoded when looked up, the links straight into
+    `Links`. `raw` is the record as received, which binary peers get forwarded
+    without encoding it again.
+    """
+
+    __slots__ = (
+        "buffer",
+        "offset",
+        "end",
+        "router_id",
+        "sequence_number",
+        "link_state_id",
+        "ttl",
+        "link_count",
+        "prefix_count",
+    )
+
+    KEYS = ("router_id", "sequence_number", "link_state_id", "links", "prefixes", "ttl")
+
+    def __init__(self, buffer, offset=0):
+        (
+            self.router_id,
+            self.sequence_number,
+            self.link_state_id,
+            self.ttl,
+            self.link_count,
+            self.prefix_count,
+        ) = LSA_HEADER.unpack_from(buffer, offset)
+        self.buffer = buffer
+        self.offset = offset
+        self.end = (
+            offset
+            + LSA_HEADER.size
+            + self.link_count * LINK.size
+            + self.prefix_count * PREFIX.size
+        )
+        if self.end > len(buffer):
+            raise struct.error("LSA record runs past the end of the frame")
+
+    def __getitem__(self, key):
+        if key == "links":
+            return self.decode_links()
+        if key == "prefixes":
+            return self.decode_prefixes()
+        if key in self.KEYS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __str__(self):
+        return f"LsaRecord({self.to_dict()})"
+
+    def __repr__(self):
+        return str(self)
+
+    def decode_links(self):
+        count = self.link_count
+        block = LINK_BLOCKS.get(count)
+        if block is None:
+            block = LINK_BLOCKS[count] = struct.Struct("!" + "qi" * count)
+        return Links.from_packed(
+            array("q", block.unpack_from(self.buffer, self.offset + LSA_HEADER.size))
+        )
+
+    def decode_prefixes(self):
+        if not self.prefix_count:
+            return []
+        start = self.offset + LSA_HEADER.size + self.link_count * LINK.size
+        return [
+            IpPrefixTrie.format_prefix(network, prefix_len)
+            for network, prefix_len in PREFIX.iter_unpack(self.buffer[start:self.end])
+        ]
+
+    def to_packet(self):
+        return LinkStatePacket(
+            self.router_id,
+            self.sequence_number,
+            self.link_state_id,
+            self.decode_links(),
+            self.ttl,
+            self.decode_prefixes(),
+        )
+
+    def raw(self):
+        return bytes(self.buffer[self.offset:self.end])
+
+    def to_dict(self):
+        return {
+            "router_id": self.router_id,
+            "sequence_number": self.sequence_number,
+            "link_state_id": self.link_state_id,
+            "links": [link.to_dict() for link in self.decode_links()],
+            "prefixes": self.decode_prefixes(),
+            "ttl": self.ttl,
+        }
+
+
+def to_packet(lsa):
+    """Build a LinkStatePacket from an LSA dict or `LsaRecord`."""
+    if isinstance(lsa, LsaRecord):
+        return lsa.to_packet()
+    return LinkStatePacket.from_dict(lsa)
+
+
+def decode_binary(message_type, payload):
+    """Decode a binary frame payload into the same dict a JSON frame yields,
+    except that LSAs come back as `LsaRecord`s over `payload`.
+
+    Fields are unpacked in place from a memoryview over `payload`; no
+    intermediate slices are made.
+    """
+    view = memoryview(payload)
+    name = MESSAGE_NAMES.get(message_type)
+    if name is None:
+        return {"type": f"unknown:{message_type}"}
+    if message_type == HELLO:
+        sender, cost, length = HELLO_HEADER.unpack_from(view)
+        start = HELLO_HEADER.size
+        capabilities = str(view[start:start + length], "utf-8")
+        return {
+            "type": name,
+            "id": sender,
+            "cost": cost,
+            "capabilities": capabilities.split(",") if capabilities else [],
+        }
+
+    if message_type == SUMMARY:
+        sender, count = ENTRY_LIST_HEADER.unpack_from(view)
+        end = ENTRY_LIST_HEADER.size + count * LSA_SUMMARY.size
+        headers = [
+            {
+                "router_id": router_id,
+                "link_state_id": link_state_id,
+                "sequence_number": sequence_number,
+            }
+            for router_id, link_state_id, sequence_number in LSA_SUMMARY.iter_unpack(
+                view[ENTRY_LIST_HEADER.size:end]
+            )
+        ]
+        return {"type": name, "id": sender, "headers": headers}
+    if message_type == REQUEST:
+        sender, count = ENTRY_LIST_HEADER.unpack_from(view)
+        end = ENTRY_LIST_HEADER.size + count * LINK_STATE_ID.size
+        link_state_ids = [
+            link_state_id
+            for link_state_id, in LINK_STATE_ID.iter_unpack(
+                view[ENTRY_LIST_HEADER.size:end]
+            )
+        ]
+        return {"type": name, "id": sender, "link_state_ids": link_state_ids}
+
+    sender, count = LSA_LIST_HEADER.unpack_from(view)
+    offset = LSA_LIST_HEADER.size
+    lsas = []
+    for _ in range(count):
+        lsa = LsaRecord(view, offset)
+        offset = lsa.end
+        lsas.append(lsa)
+    return {"type": name, "id": sender, "lsas": lsas}
+
+
+def decode_lsa(view, offset):
+    (
+        router_id,
+        sequence_number,
+        link_state_id,
+        ttl,
+        count,
+        prefix_count,
+    ) = LSA_HEADER.unpack_from(view, offset)
+    offset += LSA_HEADER.size
+    links = []
+    for link_id, cost in LINK.iter_unpack(view[offset:offset + count * LINK.size]):
+        links.append({"link_id": link_id, "cost": cost})
+    offset += count * LINK.size
+    prefixes = [
+        IpPrefixTrie.format_prefix(network, prefix_len)
+        for network, prefix_len in PREFIX.iter_unpack(
+            view[offset:offset + prefix_count * PREFIX.size]
+        )
+    ]
+    offset += prefix_count * PREFIX.size
+    lsa = {
+        "router_id": router_id,
+        "sequence_number": sequence_number,
+        "link_state_id": link_state_id,
+        "links": links,
+        "prefixes": prefixes,
+        "ttl": ttl,
+    }
+    return lsa, offset
+
+
+async def read_frame(reader):
+    """Read the next complete frame from `reader`, whichever encoding it uses.
+
+    Raises ValueError for a binary frame longer than `MAX_FRAME_SIZE`, and the
+    reader raises `asyncio.LimitOverrunError` for a JSON frame over its limit.
+    """
+    first = await reader.readexactly(1)
+    if first[0] == MAGIC:
+        header = first + await reader.readexactly(FRAME_HEADER.size - 1)
+        _, _, length = FRAME_HEADER.unpack(header)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame of {length} bytes exceeds {MAX_FRAME_SIZE}")
+        return header + await reader.readexactly(length)
+    return first + await reader.readuntil(b"\r\n")
+
+
+def decode_frame(frame):
+    """Decode a frame from `read_frame`; raises ValueError or struct.error if
+    it is malformed."""
+    if frame[0] == MAGIC:
+        _, message_type, _ = FRAME_HEADER.unpack_from(frame)
+        message = decode_binary(
+            message_type & ~(MORE | REPLY), memoryview(frame)[FRAME_HEADER.size:]
+        )
+        if message_type & MORE:
+            message["more"] = True
+        if message_type & REPLY:
+            message["reply"] = True
+        return message
+    message = json.loads(frame)
+    if not isinstance(message, dict):
+        raise ValueError(f"Expected a JSON object, got {type(message).__name__}")
+    return message